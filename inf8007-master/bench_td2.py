@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from os.path import join
+from resource import getrusage, RUSAGE_SELF
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+import numpy as np
+
+from td2 import SearchEngine, ShardedSearchEngine, SparseMatrix, FeatureHasher, Catalog, \
+    list_courses, parse_course
+
+
+# --------------------------------------------------------------------------------- argument parsing
+def parse_arguments(args_=None):
+    parser = argparse.ArgumentParser(description='Mesures de performance du moteur du TD2')
+    parser.add_argument('-d', type=str, dest='path', help='Chemin vers la liste de fichiers')
+    parser.add_argument('-k', type=int, dest='k', help='Nombre de résultats par recherche')
+    parser.add_argument('--clusters', type=int, dest='clusters',
+                        help='Nombre de groupes de l’index IVF (√cours par défaut)')
+    parser.add_argument('--nprobe', type=int, nargs='+', dest='nprobe',
+                        help='Nombres de groupes visités par requête IVF')
+    parser.add_argument('--dtypes', type=str, nargs='+', dest='dtypes',
+                        choices=SparseMatrix.DTYPES[1:],
+                        help='Types de stockage comparés à la pleine précision')
+    parser.add_argument('--hash', type=int, nargs='+', dest='hash', metavar='BITS',
+                        help='Nombres de bits des colonnes hachées comparées au vocabulaire')
+    parser.add_argument('--bigrams', dest='bigrams', action='store_true',
+                        help='Indexe aussi les paires de mots consécutifs')
+    parser.add_argument('--shards', type=int, nargs='+', dest='shards', metavar='PROCESSUS',
+                        help='Nombres de processus des index répartis comparés à un seul index')
+    parser.add_argument('--imports', type=str, nargs='*', dest='imports', metavar='MODULE',
+                        help='Mesure le temps d’importation des modules (td2 et td3 par '
+                             'défaut) avec python -X importtime')
+    parser.add_argument('--sizes', type=int, nargs='*', dest='sizes', metavar='COURS',
+                        help='Mesure la construction et les requêtes sur des catalogues '
+                             'synthétiques de COURS cours, modelés sur ceux de --sample (1k à '
+                             '1M par défaut)')
+    parser.add_argument('--sample', type=str, dest='sample', metavar='CHEMIN',
+                        help='Cours dont les catalogues synthétiques reprennent les mots et les '
+                             'longueurs')
+    parser.add_argument('--queries', type=int, dest='queries',
+                        help='Nombre de requêtes mesurées par catalogue synthétique')
+    parser.add_argument('-o', '--output', type=str, dest='output', metavar='FICHIER',
+                        help='Écrit les mesures des catalogues synthétiques ou des importations '
+                             'en JSON')
+    parser.add_argument('--baseline', type=str, dest='baseline', metavar='FICHIER',
+                        help='Mesures JSON de référence, les régressions sont signalées')
+    parser.add_argument('--tolerance', type=float, dest='tolerance',
+                        help='Dégradation relative tolérée par rapport à la référence')
+    parser.set_defaults(path='02/PolyHEC', k=10, clusters=None, nprobe=[1, 2, 4, 8],
+                        dtypes=['float32', 'float16', 'int8'], hash=[8, 12, 16, 20],
+                        bigrams=False, shards=[2, 4], imports=None, sizes=None, sample='02/sample',
+                        queries=100, output=None, baseline=None, tolerance=.2)
+    return parser.parse_args(args_)
+
+
+# -------------------------------------------------------------------------------------------- utils
+def timed(function, *args, **kwargs):
+    """ Call a function, return its result and the time it took in seconds. """
+    start = perf_counter()
+    rv = function(*args, **kwargs)
+    return rv, perf_counter() - start
+
+
+def query_latency(search, acronyms, k):
+    """ Mean time of a search over every given course, in seconds. """
+    return sum(timed(search, acronym, k=k)[1] for acronym in acronyms) / len(acronyms)
+
+
+# ------------------------------------------------------------------------------------------- benchs
+def bench_ivf(engine, clusters=None, nprobes=(1, 2, 4, 8), k=10):
+    """ Compare the IVF search with the exhaustive one: build time, mean query latency and
+        recall@k, for each number of probed clusters. """
+    acronyms = engine.acronyms
+    rv = [dict(method='exact', build=0., latency=query_latency(engine.search, acronyms, k),
+               recall=1.)]
+    _, build_time = timed(engine.build_ivf, clusters)
+    for nprobe in nprobes:
+        search = partial(engine.search_ivf, nprobe=nprobe)
+        rv.append(dict(method='ivf nprobe={}'.format(nprobe), build=build_time,
+                       latency=query_latency(search, acronyms, k),
+                       recall=engine.recall(search, acronyms, k)))
+    return rv
+
+
+def ranking_drift(engine, reference, k=10):
+    """ Share of the top-k of `reference` found by `engine` (recall@k), share of queries with the
+        very same top-k, and mean absolute score error, over every course. """
+    acronyms = reference.acronyms
+    found = same = error = 0
+    for acronym in acronyms:
+        exact = [acr for (acr, _) in reference.search(acronym, k=k)]
+        results = [acr for (acr, _) in engine.search(acronym, k=k)]
+        found += len(set(results).intersection(exact)) / max(1, len(results))
+        same += results == exact
+        error += np.abs(engine.scores(acronym) - reference.scores(acronym)).mean()
+    return dict(recall=found / len(acronyms), same=same / len(acronyms),
+                error=error / len(acronyms))
+
+
+def bench_dtypes(files, dtypes=('float32', 'float16', 'int8'), k=10):
+    """ Ranking drift of quantized engines against a float64 one, for each storage type: memory
+        of the vectors and term postings, mean query latency, and `ranking_drift`. """
+    reference = SearchEngine(files)
+    rv = []
+    for dtype in ('float64',) + tuple(dtypes):
+        engine = reference if dtype == 'float64' else SearchEngine(files, dtype=dtype)
+        rv.append(dict(method=dtype, memory=engine.vectors.nbytes + engine.term_postings.nbytes,
+                       latency=query_latency(engine.search, engine.acronyms, k),
+                       **ranking_drift(engine, reference, k)))
+    return rv
+
+
+def bench_hashing(files, bits=(8, 12, 16, 20), bigrams=False, k=10):
+    """ Ranking drift of engines hashing their terms on 2^bits columns against one numbering them
+        with a vocabulary: distinct terms, share of them colliding with another term, memory of
+        the vectors and term postings, and `ranking_drift`. """
+    reference = SearchEngine(files, bigrams=bigrams)
+    terms = list(reference.words_index)
+    rv = [dict(method='vocabulaire', terms=len(terms), collisions=0.,
+               memory=reference.vectors.nbytes + reference.term_postings.nbytes,
+               **ranking_drift(reference, reference, k))]
+    for bits_ in bits:
+        engine = SearchEngine(files, hash_size=2 ** bits_, bigrams=bigrams)
+        rv.append(dict(method='2^{} colonnes'.format(bits_), terms=len(terms),
+                       collisions=FeatureHasher(2 ** bits_).collision_rate(terms),
+                       memory=engine.vectors.nbytes + engine.term_postings.nbytes,
+                       **ranking_drift(engine, reference, k)))
+    return rv
+
+
+def bench_shards(files, shards=(2, 4), k=10):
+    """ Build time and mean query latency of engines sharded across processes, against a single
+        engine, and the share of its top-k they find (courses sharing no word with the query
+        and ties at the k-th score aside, the same). """
+    reference, build_time = timed(SearchEngine, files)
+    acronyms = reference.acronyms
+    rv = [dict(method='1 index', build=build_time,
+               latency=query_latency(reference.search, acronyms, k), recall=1.)]
+    for shards_ in shards:
+        engine, build_time = timed(ShardedSearchEngine, files, shards_)
+        with engine:
+            rv.append(dict(method='{} processus'.format(shards_), build=build_time,
+                           latency=query_latency(engine.search, acronyms, k),
+                           recall=engine_recall(engine, reference, acronyms, k)))
+    return rv
+
+
+def engine_recall(engine, reference, acronyms, k=10):
+    """ Share of the top-k of `reference` found by `engine`. """
+    found = 0
+    for acronym in acronyms:
+        exact = {acr for (acr, _) in reference.search(acronym, k=k)}
+        found += len(exact.intersection(acr for (acr, _) in engine.search(acronym, k=k))) / \
+            max(1, len(exact))
+    return found / len(acronyms)
+
+
+# --------------------------------------------------------------------------------- synthetic corpus
+WORD = re.compile(r"[^\W\d_]+")
+# vocabulary growth (Heaps' law: K·tokens^β words) and word frequencies (Zipf's law: 1/rank^s)
+HEAPS_K, HEAPS_BETA = 30, .55
+ZIPF_EXPONENT = 1.07
+TITLE_WORDS = 4
+
+
+def vocabulary_model(path):
+    """ Words of the course descriptions of `path`, most frequent first, and the number of words
+        of each description. """
+    counts, lengths = Counter(), []
+    for course in list_courses(path):
+        words = WORD.findall(parse_course(course)[1].lower() if isinstance(course, str)
+                             else course[2].lower())
+        counts.update(words)
+        lengths.append(len(words))
+    return [word for (word, _) in counts.most_common()], lengths
+
+
+def synthetic_acronym(i):
+    letters = ''.join(chr(ord('A') + i // 10000 // 26 ** j % 26) for j in (2, 1, 0))
+    return '{}{:04d}'.format(letters, i % 10000)
+
+
+def synthetic_courses(size, words, lengths, seed=0):
+    """ Generate `size` (acronym, title, description) records. Description lengths are drawn from
+        `lengths`, words follow Zipf's law over `words` extended with words made of the halves of
+        two of them, so that the vocabulary grows with the catalog as Heaps' law says. """
+    rng = np.random.RandomState(seed)
+    tokens = size * (np.mean(lengths) + TITLE_WORDS)
+    pairs = rng.randint(len(words), size=(max(0, int(HEAPS_K * tokens ** HEAPS_BETA) -
+                                              len(words)), 2))
+    vocabulary = np.array(words + [words[a][:(len(words[a]) + 1) // 2] +
+                                   words[b][len(words[b]) // 2:] for (a, b) in pairs])
+    cumulative = np.cumsum(1 / np.arange(1, len(vocabulary) + 1) ** ZIPF_EXPONENT)
+    cumulative /= cumulative[-1]
+    for i in range(size):
+        length = lengths[rng.randint(len(lengths))] + TITLE_WORDS
+        text = vocabulary[np.searchsorted(cumulative, rng.random_sample(length))]
+        yield (synthetic_acronym(i), ' '.join(text[:TITLE_WORDS]).capitalize(),
+               ' '.join(text[TITLE_WORDS:]).capitalize() + '.')
+
+
+def bench_scale(size, sample='02/sample', queries=100, k=10, seed=0):
+    """ Index `size` synthetic courses modeled on those of `sample`: generation and build time,
+        peak RSS of the process, p50 and p99 `search` latency over `queries` distinct courses. Run
+        it in a fresh process (see `bench_scales`) so that the peak RSS is its own. """
+    words, lengths = vocabulary_model(sample)
+    with TemporaryDirectory() as directory:
+        path = join(directory, 'catalog.jsonl')
+        _, generation = timed(Catalog.write, path, synthetic_courses(size, words, lengths, seed))
+        engine, build = timed(SearchEngine, Catalog(path))
+        acronyms = np.random.RandomState(seed).choice(engine.acronyms, min(queries, size),
+                                                      replace=False)
+        latencies = [timed(engine.search, acronym, k=k)[1] for acronym in acronyms]
+        return dict(documents=size, words=len(engine.words_index), generation=generation,
+                    build=build, rss=getrusage(RUSAGE_SELF).ru_maxrss * 1024,
+                    p50=float(np.percentile(latencies, 50)),
+                    p99=float(np.percentile(latencies, 99)))
+
+
+def bench_scales(sizes, sample='02/sample', queries=100, k=10, seed=0):
+    """ `bench_scale` for each size, each one in its own process. """
+    rv = []
+    for size in sizes:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            rv.append(executor.submit(bench_scale, size, sample, queries, k, seed).result())
+    return rv
+
+
+def regressions(results, baseline, tolerance=.2):
+    """ Measures of `results` worse than those of `baseline` for the same catalog size by more
+        than `tolerance` (relative), as (size, measure, baseline value, value) tuples. """
+    reference = {result['documents']: result for result in baseline}
+    return [(result['documents'], measure, reference[result['documents']][measure],
+             result[measure])
+            for result in results if result['documents'] in reference
+            for measure in ('build', 'rss', 'p50', 'p99')
+            if result[measure] > reference[result['documents']][measure] * (1 + tolerance)]
+
+
+# ------------------------------------------------------------------------------------------ imports
+IMPORT_TIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_times(module):
+    """ Import `module` in a fresh interpreter, return the cumulative import time of it and of each
+        of its dependencies in seconds, as a {module: time} dict. """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                             stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return {match.group(4): int(match.group(2)) / 1e6
+            for match in map(IMPORT_TIME.match, process.stderr.splitlines()) if match}
+
+
+def bench_imports(modules=('td2', 'td3'), repeat=5, top=3):
+    """ Import time of each module, the best of `repeat` fresh interpreters, and its `top`
+        slowest dependencies. """
+    rv = []
+    for module in modules:
+        times = [import_times(module) for _ in range(repeat)]
+        best = {name: min(run.get(name, float('inf')) for run in times) for name in times[0]}
+        slowest = sorted((name for name in best if name != module and '.' not in name),
+                         key=best.get, reverse=True)[:top]
+        rv.append(dict(module=module, time=best[module],
+                       dependencies=[(name, best[name]) for name in slowest]))
+    return rv
+
+
+# --------------------------------------------------------------------------------- main application
+def main_imports(modules, output=None, baseline=None, tolerance=.2):
+    print('{:<10} {:>10}  {}'.format('module', 'temps (ms)', 'dépendances les plus lentes (ms)'))
+    results = bench_imports(modules)
+    for result in results:
+        print('{:<10} {:>10.1f}  {}'.format(result['module'], result['time'] * 1000, ', '.join(
+            '{} {:.1f}'.format(name, time * 1000) for (name, time) in result['dependencies'])))
+    if output is not None:
+        with open(output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+    if baseline is not None:
+        with open(baseline) as stream:
+            reference = {result['module']: result['time'] for result in json.load(stream)}
+        found = [result for result in results if result['module'] in reference and
+                 result['time'] > reference[result['module']] * (1 + tolerance)]
+        for result in found:
+            print('Régression pour {}: {:.1f} ms (référence {:.1f} ms)'.format(
+                result['module'], result['time'] * 1000, reference[result['module']] * 1000))
+        return not found
+    return True
+
+
+def main_scales(sizes, sample='02/sample', queries=100, k=10, output=None, baseline=None,
+                tolerance=.2):
+    print('{:>9} {:>9} {:>12} {:>12} {:>10} {:>10} {:>10}'.format(
+        'cours', 'mots', 'création (s)', 'index (s)', 'RSS (Mo)', 'p50 (ms)', 'p99 (ms)'))
+    results = []
+    for result in bench_scales(sizes, sample, queries, k):
+        results.append(result)
+        print('{documents:>9} {words:>9} {generation:>12.3f} {build:>12.3f} {rss_mb:>10.1f} '
+              '{p50_ms:>10.3f} {p99_ms:>10.3f}'.format(rss_mb=result['rss'] / 2 ** 20,
+                                                       p50_ms=result['p50'] * 1000,
+                                                       p99_ms=result['p99'] * 1000, **result))
+    if output is not None:
+        with open(output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+    if baseline is not None:
+        with open(baseline) as stream:
+            found = regressions(results, json.load(stream), tolerance)
+        for size, measure, expected, value in found:
+            print('Régression pour {} cours: {} = {:.4g} (référence {:.4g})'.format(
+                size, measure, value, expected))
+        return not found
+    return True
+
+
+def main(path, k=10, clusters=None, nprobes=(1, 2, 4, 8), dtypes=('float32', 'float16', 'int8'),
+         bits=(8, 12, 16, 20), bigrams=False, shards=(2, 4)):
+    files = list_courses(path)
+    engine, build_time = timed(SearchEngine, files)
+    print('{} cours indexés en {:.3f}s'.format(len(engine.acronyms), build_time))
+    print('{:<16} {:>10} {:>12} {:>10}'.format('méthode', 'index (s)', 'requête (ms)',
+                                               'rappel@{}'.format(k)))
+    for result in bench_ivf(engine, clusters, nprobes, k):
+        print('{method:<16} {build:>10.3f} {latency_ms:>12.3f} {recall:>10.3f}'.format(
+            latency_ms=result['latency'] * 1000, **result))
+    print()
+    print('{:<16} {:>12} {:>12} {:>10} {:>10} {:>10}'.format(
+        'stockage', 'mémoire (o)', 'requête (ms)', 'rappel@{}'.format(k),
+        'top-{} égal'.format(k), 'écart'))
+    for result in bench_dtypes(files, dtypes, k):
+        print('{method:<16} {memory:>12} {latency_ms:>12.3f} {recall:>10.3f} {same:>10.3f} '
+              '{error:>10.2e}'.format(latency_ms=result['latency'] * 1000, **result))
+    print()
+    print('{:<16} {:>10} {:>10} {:>12} {:>10} {:>10} {:>10}'.format(
+        'termes', 'distincts', 'collisions', 'mémoire (o)', 'rappel@{}'.format(k),
+        'top-{} égal'.format(k), 'écart'))
+    for result in bench_hashing(files, bits, bigrams, k):
+        print('{method:<16} {terms:>10} {collisions:>10.3f} {memory:>12} {recall:>10.3f} '
+              '{same:>10.3f} {error:>10.2e}'.format(**result))
+    print()
+    print('{:<16} {:>10} {:>12} {:>10}'.format('répartition', 'index (s)', 'requête (ms)',
+                                               'rappel@{}'.format(k)))
+    for result in bench_shards(files, shards, k):
+        print('{method:<16} {build:>10.3f} {latency_ms:>12.3f} {recall:>10.3f}'.format(
+            latency_ms=result['latency'] * 1000, **result))
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.imports is not None:
+        sys.exit(not main_imports(args.imports or ['td2', 'td3'], args.output, args.baseline,
+                                  args.tolerance))
+    if args.sizes is not None:
+        sys.exit(not main_scales(args.sizes or [1000, 10000, 100000, 1000000], args.sample,
+                                 args.queries, args.k, args.output, args.baseline,
+                                 args.tolerance))
+    main(path=args.path, k=args.k, clusters=args.clusters, nprobes=args.nprobe,
+         dtypes=args.dtypes, bits=args.hash, bigrams=args.bigrams, shards=args.shards)
@@ -1,18 +1,19 @@
 #!/usr/bin/env python
-from functools import reduce
-from collections import namedtuple, defaultdict
-from operator import itemgetter
-
-from nltk.corpus import stopwords
-from nltk.stem import SnowballStemmer
-
-from os import listdir
-from os.path import isfile, join, basename
+from collections import namedtuple, defaultdict, deque, Counter, OrderedDict
+from contextlib import contextmanager
+from glob import glob
+from itertools import chain, islice
+from mmap import mmap, ACCESS_READ
+from os import listdir, makedirs, stat, cpu_count, remove
+from os.path import isfile, join, basename, abspath
+from sys import intern, stdin
+from time import perf_counter
+from zlib import crc32
 import re
+import json
 import argparse
 
-from numpy.dual import norm
-from numpy.ma import dot
+import numpy as np
 
 
 # --------------------------------------------------------------------------------- argument parsing
@@ -24,8 +25,11 @@ def parse_arguments(args_=None):
             raise argparse.ArgumentTypeError('"{}" n’est pas un sigle de cours correct'.format(v))
 
     parser = argparse.ArgumentParser(description='Script du TD2, similarité de textes')
-    parser.add_argument('acronym', metavar='SIGLE', type=acronym, nargs='?',
-                        help='Nom du cours à verifier')
+    parser.add_argument('acronym', metavar='SIGLE', type=acronym, nargs='*',
+                        help='Nom des cours à verifier')
+    parser.add_argument('-f', '--file', type=str, dest='acronyms_file', metavar='FICHIER',
+                        help='Fichier des sigles des cours à vérifier, un par ligne (- pour '
+                             'l’entrée standard)')
     parser.add_argument('-d', type=str, dest='path', help='Chemin vers la liste de fichiers')
     parser.add_argument('-n', type=int, dest='length', help='Nombre de résultats à afficher')
     parser_verbose_handling = parser.add_mutually_exclusive_group(required=False)
@@ -33,11 +37,98 @@ def parse_arguments(args_=None):
                                          help="Affiche beaucoup d’informations")
     parser_verbose_handling.add_argument('-q', '--quiet', dest='verbose', action='store_false',
                                          help="Affiche le minimum d’informations")
-    parser.set_defaults(acronym='INF8007', path='02/PolyHEC', length=10, verbose=True)
-    return parser.parse_args(args_)
+    parser.add_argument('--all-pairs', type=str, dest='all_pairs', metavar='FICHIER',
+                        help='Calcule la similarité de toutes les paires de cours dans FICHIER')
+    parser.add_argument('--memory', type=int, dest='memory', metavar='Mo',
+                        help='Mémoire maximale utilisée par le calcul de toutes les paires')
+    parser.add_argument('-i', '--index', type=str, dest='snapshot', metavar='DOSSIER',
+                        help='Instantané de l’index, reconstruit s’il est absent ou périmé')
+    parser.add_argument('-j', '--workers', type=int, dest='workers',
+                        help='Nombre de processus utilisés pour lire les cours')
+    parser.add_argument('--lsh', type=int, nargs=2, dest='lsh', metavar=('TABLES', 'BITS'),
+                        help='Recherche approximée avec TABLES tables LSH de BITS bits')
+    parser.add_argument('--lsa', type=int, dest='lsa', metavar='DIMENSIONS',
+                        help='Recherche dans un espace sémantique latent de DIMENSIONS dimensions')
+    parser.add_argument('--dtype', type=str, dest='dtype', choices=SparseMatrix.DTYPES,
+                        help='Type des vecteurs (float16 et int8 avec un facteur par vecteur)')
+    parser.add_argument('--hash', type=int, dest='hash', metavar='BITS',
+                        help='Hache les termes sur 2^BITS colonnes au lieu d’un vocabulaire')
+    parser.add_argument('--bigrams', dest='bigrams', action='store_true',
+                        help='Indexe aussi les paires de mots consécutifs')
+    parser.add_argument('--shards', type=int, dest='shards', metavar='PROCESSUS',
+                        help='Répartit les cours entre PROCESSUS processus interrogés en '
+                             'parallèle (recherche exacte par cosinus, sans instantané)')
+    parser.add_argument('--scorer', type=str, dest='scorer', choices=SearchEngine.SCORERS,
+                        help='Score des recherches exactes: cosinus tf*idf ou Okapi BM25')
+    parser.add_argument('--convert', type=str, dest='convert', metavar='FICHIER',
+                        help='Convertit le dossier de cours en un catalogue FICHIER (.jsonl ou '
+                             '.tsv), utilisable ensuite avec -d')
+    parser.add_argument('--profile', type=str, nargs='?', const='', dest='profile',
+                        metavar='FICHIER',
+                        help='Affiche le temps passé dans chaque étape, et enregistre le profil '
+                             'cProfile dans FICHIER s’il est donné')
+    parser.set_defaults(acronym=['INF8007'], acronyms_file=None, path='02/PolyHEC', length=10,
+                        verbose=True, all_pairs=None, memory=64, snapshot=None, workers=1,
+                        lsh=None, lsa=None, dtype='float64', hash=None, bigrams=False,
+                        shards=None, scorer='cosine', convert=None, profile=None)
+    args = parser.parse_args(args_)
+    if args.shards:
+        # shards only answer exact cosine searches, and are built from the courses every time
+        for option, given in (('--lsh', args.lsh), ('--lsa', args.lsa),
+                              ('--scorer ' + args.scorer,
+                               args.scorer not in ShardedSearchEngine.SCORERS),
+                              ('-i', args.snapshot), ('-j', args.workers != 1),
+                              ('--all-pairs', args.all_pairs)):
+            if given:
+                parser.error('{} ne peut pas être utilisé avec --shards'.format(option))
+    return args
 
 
 # -------------------------------------------------------------------------------------------- utils
+def list_courses(path):
+    """ List the course files of a directory, or open the catalog if `path` is a file. """
+    if isfile(path):
+        return Catalog(path)
+    return [join(path, f) for f in listdir(path) if isfile(join(path, f))]
+
+
+def tokenize_course(parser, course, profiler=None):
+    """ Parse a course, either a file or a (acronym, title, description) catalog record, return
+        the tokens of its description and title. """
+    profiler = Profiler() if profiler is None else profiler
+    with profiler.stage('parsing'):
+        title, original_content = parse_course(course) if isinstance(course, str) \
+            else course[1:]
+    with profiler.stage('tokenizing'):
+        return parser.tokenize(original_content) + parser.tokenize(title)
+
+
+_worker_parsers = {}
+
+
+def _tokenize_courses(courses, language):
+    """ Task of the parallel ingestion, each worker process keeps its own parser. """
+    if language not in _worker_parsers:
+        _worker_parsers[language] = Parser(language=language, default_remove_stopwords=True,
+                                           default_stem=True)
+    return [tokenize_course(_worker_parsers[language], course) for course in courses]
+
+
+def open_engine(files, snapshot=None, workers=1, dtype='float64', hash_size=None, bigrams=False):
+    """ Load the search engine from a snapshot if it is up to date, otherwise build it (and save
+        the snapshot when a path is given). """
+    if snapshot is not None:
+        try:
+            return SearchEngine.load(snapshot, files, dtype, FeatureHasher(hash_size, bigrams))
+        except (FileNotFoundError, StaleSnapshotError):
+            pass
+    engine = SearchEngine(files, workers=workers, dtype=dtype, hash_size=hash_size,
+                          bigrams=bigrams)
+    if snapshot is not None:
+        engine.save(snapshot)
+    return engine
+
+
 def parse_course(path, do_raise=False):
     """ Parse a course file to retrieve it’s title and description, may raise error if file is
         corrupted or not found """
@@ -52,24 +143,191 @@ def parse_course(path, do_raise=False):
     return title, description
 
 
-class Keydefaultdict(defaultdict):
-    def __missing__(self, key):
-        if self.default_factory is None:
-            raise KeyError(key)
-        else:
-            ret = self[key] = self.default_factory(key)
-            return ret
+class Catalog:
+    """ Courses stored in a single file, one record per line: either JSON objects with acronym,
+        title and description keys (.jsonl), or acronym, title and description separated by tabs
+        with backslash escapes (.tsv). The file is memory-mapped and scanned once, when the
+        records are first needed, to find their offsets. Records are then only read on demand. """
+
+    ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+    UNESCAPES = {escape: char for (char, escape) in ESCAPES.items()}
+    # acronym at the start of a JSON record, as written by `write`
+    ACRONYM = re.compile(rb'\{\s*"acronym"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+    def __init__(self, path, offsets=None):
+        """ `offsets` ({acronym: (start, end)}, as in `self.offsets`) saves the scan. """
+        self.path = path
+        self.tsv = path.endswith('.tsv')
+        with open(path, 'rb') as stream:
+            # an empty file cannot be mapped
+            self.data = mmap(stream.fileno(), 0, access=ACCESS_READ) if stat(path).st_size \
+                else b''
+        self.__offsets = offsets
+
+    @property
+    def offsets(self):
+        if self.__offsets is None:
+            self.__offsets = self.__scan()
+        return self.__offsets
+
+    def __scan(self):
+        """ Offsets of the records. Only the acronym of a JSON record is decoded when it comes
+            first, other records are decoded entirely. """
+        offsets = OrderedDict()
+        start = 0
+        while start < len(self.data):
+            end = self.data.find(b'\n', start)
+            end = len(self.data) if end < 0 else end
+            if end > start:
+                if self.tsv:
+                    acronym = self.data[start:self.data.find(b'\t', start, end)].decode()
+                else:
+                    match = self.ACRONYM.match(self.data, start, end)
+                    acronym = json.loads(match.group(1).decode()) if match else \
+                        json.loads(self.data[start:end].decode())['acronym']
+                offsets[acronym] = (start, end)
+            start = end + 1
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, acronym):
+        return acronym in self.offsets
+
+    def __iter__(self):
+        """ Records of the catalog, as (acronym, title, description) tuples. """
+        return (self.record(acronym) for acronym in self.offsets)
+
+    def record(self, acronym):
+        start, end = self.offsets[acronym]
+        line = self.data[start:end].decode()
+        if self.tsv:
+            return tuple(re.sub(r'\\.', lambda match: self.UNESCAPES.get(match.group(0),
+                                                                          match.group(0)), field)
+                         for field in line.split('\t'))
+        record = json.loads(line)
+        return record['acronym'], record['title'], record['description']
+
+    @classmethod
+    def write(cls, path, records):
+        """ Write (acronym, title, description) records, in the format given by the extension of
+            `path`. """
+        with open(path, 'w') as stream:
+            for record in records:
+                if path.endswith('.tsv'):
+                    stream.write('\t'.join(''.join(cls.ESCAPES.get(char, char) for char in field)
+                                           for field in record) + '\n')
+                else:
+                    stream.write(json.dumps(dict(zip(('acronym', 'title', 'description'),
+                                                     record)), ensure_ascii=False) + '\n')
+
+
+StageStats = namedtuple('StageStats', 'calls time')
+
+
+class Profiler:
+    """ Number of calls and total time of named stages, see `stage`. """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """ Context manager timing a run of the `name` stage. """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            calls, time = self.stages.get(name, (0, 0.))
+            self.stages[name] = StageStats(calls + 1, time + perf_counter() - start)
+
+
+def convert_catalog(path, output):
+    """ Write the course files of the `path` directory as a single catalog file. """
+    Catalog.write(output, ((basename(file)[:-4],) + parse_course(file)
+                           for file in sorted(list_courses(path))))
 
 
 # -------------------------------------------------------------------------------------- text parser
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+# stopword lists by language, shared by the parsers of a process
+_stopwords = {}
+
+
+def stopword_set(language):
+    """ Stopwords of `language`. nltk takes most of the import time of this module, it is only
+        imported when a parser needs its stopwords or its stemmer. """
+    if language not in _stopwords:
+        from nltk.corpus import stopwords
+        _stopwords[language] = frozenset(stopwords.words(language))
+    return _stopwords[language]
+
+
 class Parser:
     WORD_SEPARATOR = r'(?:(?:&nbsp)?[\s.,:;?!()\\/\'\"])+'
 
-    def __init__(self, language='french', default_remove_stopwords=False, default_stem=False):
-        self.stopwords = set(stopwords.words(language))
-        self.stemmer = SnowballStemmer(language=language)
+    def __init__(self, language='french', default_remove_stopwords=False, default_stem=False,
+                 stem_cache_size=2 ** 16, stem_table=None):
+        """ Stems are memoized in a LRU cache of `stem_cache_size` words, that can be preloaded
+            from a table written by `save_stems`. The stopwords and the stemmer are loaded when
+            they are first needed. """
+        self.language = language
+        self.__stopwords = self.__stemmer = None
         self.default_remove_stopwords = default_remove_stopwords
         self.default_stem = default_stem
+        self.stems = OrderedDict()
+        self.stem_cache_size = stem_cache_size
+        self.stem_hits = self.stem_misses = 0
+        # time spent in the stemmer, on cache misses
+        self.stem_time = 0.
+        if stem_table is not None:
+            self.load_stems(stem_table)
+
+    @property
+    def stopwords(self):
+        if self.__stopwords is None:
+            self.__stopwords = stopword_set(self.language)
+        return self.__stopwords
+
+    @property
+    def stemmer(self):
+        if self.__stemmer is None:
+            from nltk.stem import SnowballStemmer
+            self.__stemmer = SnowballStemmer(language=self.language)
+        return self.__stemmer
+
+    def stem(self, word):
+        try:
+            stem = self.stems[word]
+        except KeyError:
+            self.stem_misses += 1
+            start = perf_counter()
+            stem = self.stems[word] = intern(self.stemmer.stem(word))
+            self.stem_time += perf_counter() - start
+            if len(self.stems) > self.stem_cache_size:
+                self.stems.popitem(last=False)
+            return stem
+        self.stem_hits += 1
+        self.stems.move_to_end(word)
+        return stem
+
+    def stem_cache_info(self):
+        """ Statistics of the stem cache, in the same form as functools.lru_cache. """
+        return CacheInfo(self.stem_hits, self.stem_misses, self.stem_cache_size, len(self.stems))
+
+    def save_stems(self, path):
+        """ Write the cached stems as a tab separated word → stem table. """
+        with open(path, 'w') as stream:
+            stream.writelines('{}\t{}\n'.format(word, stem) for (word, stem) in self.stems.items())
+
+    def load_stems(self, path):
+        with open(path) as stream:
+            for line in stream:
+                word, stem = line.rstrip('\n').split('\t')
+                self.stems[word] = intern(stem)
+        while len(self.stems) > self.stem_cache_size:
+            self.stems.popitem(last=False)
 
     def tokenize(self, string, remove_stop_words=None, stem=None):
         remove_stop_words = self.default_remove_stopwords if remove_stop_words is None \
@@ -80,81 +338,1606 @@ class Parser:
         # filter empty strings
         words = filter(lambda w: bool(w), words)
         if remove_stop_words:
-            words = filter(lambda w: w not in self.stopwords, words)
+            stopwords = self.stopwords
+            words = filter(lambda w: w not in stopwords, words)
         if stem:
-            words = map(self.stemmer.stem, words)
+            words = map(self.stem, words)
         # usage of map  and filter instead of array comprehension allows to iterate only once
         # through the list
         return list(words)
 
+    def iter_tokens(self, stream, remove_stop_words=None, stem=None, chunk_size=2 ** 16):
+        """ Generator version of `tokenize` for file-like objects, the stream is read by chunks of
+            `chunk_size` characters so that it never has to be fully in memory. """
+        remove_stop_words = self.default_remove_stopwords if remove_stop_words is None \
+                            else remove_stop_words
+        stem = self.default_stem if stem is None else stem
+        separator = re.compile(self.WORD_SEPARATOR)
+        stopwords = self.stopwords if remove_stop_words else ()
+        leftover = ''
+        while True:
+            chunk = stream.read(chunk_size)
+            words = separator.split((leftover + chunk).lower())
+            # the last word may continue in the next chunk, it is kept for later
+            leftover = words.pop() if chunk else ''
+            for word in words:
+                if word and word not in stopwords:
+                    yield self.stem(word) if stem else word
+            if not chunk:
+                return
+
+
+class FeatureHasher:
+    """ Terms of the parser output, words and optionally word bigrams, for the index. With a
+        `size`, each term is hashed to one of `size` columns (the hashing trick): the terms are then
+        column numbers, the index keeps no vocabulary and the vectors have a fixed width. """
+
+    def __init__(self, size=None, bigrams=False):
+        self.size = size
+        self.bigrams = bigrams
+
+    def terms(self, tokens):
+        """ Generate the terms of a sequence of tokens, a bigram is two joined tokens. """
+        previous = None
+        for token in tokens:
+            yield self.column(token) if self.size else token
+            if self.bigrams and previous is not None:
+                bigram = previous + ' ' + token
+                yield self.column(bigram) if self.size else bigram
+            previous = token
+
+    def column(self, term):
+        # crc32 does not depend on the process, unlike hash
+        return crc32(term.encode()) % self.size
+
+    def collision_rate(self, terms):
+        """ Share of the distinct `terms` sharing their column with another one. """
+        terms = set(terms)
+        columns = Counter(map(self.column, terms))
+        return sum(count for count in columns.values() if count > 1) / max(1, len(terms))
+
+
+# ------------------------------------------------------------------------------------ sparse matrix
+class SparseMatrix:
+    """ Compressed sparse row (CSR) matrix backed by numpy arrays. Rows are documents and columns
+        are words, only the operations needed by the search engine are implemented.
+
+        Values may be stored as float64, float32, float16 or int8 (see `astype`). float16 and int8
+        values come with one scale factor per row: the actual value is `data * scales[row]`. """
+
+    ARRAYS = ('indptr', 'indices', 'data', 'row_ids')
+    DTYPES = ('float64', 'float32', 'float16', 'int8')
+    # biggest stored value of each row for the types stored with scale factors
+    SCALED = {'float16': 1, 'int8': 127}
+
+    def __init__(self, indptr, indices, data, shape, row_ids=None, scales=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        # column and row numbers fit in 32 bits, values can take less space than them
+        self.indices = np.asarray(indices, dtype=np.int32)
+        # arrays keep their storage type, anything else is read as float64
+        self.data = data if isinstance(data, np.ndarray) and data.dtype.name in self.DTYPES \
+            else np.asarray(data, dtype=np.float64)
+        self.shape = tuple(shape)
+        # row number of every stored value, used to accumulate products row by row
+        self.row_ids = np.repeat(np.arange(shape[0], dtype=np.int32), np.diff(self.indptr)) \
+            if row_ids is None else np.asarray(row_ids, dtype=np.int32)
+        self.scales = scales
+
+    @property
+    def dtype(self):
+        return self.data.dtype.name
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS) + \
+            (0 if self.scales is None else self.scales.nbytes)
+
+    def save(self, prefix):
+        for name in self.ARRAYS:
+            np.save('{}.{}.npy'.format(prefix, name), getattr(self, name))
+        if self.scales is not None:
+            np.save('{}.scales.npy'.format(prefix), self.scales)
+
+    @classmethod
+    def load(cls, prefix, shape, mmap_mode='r', scaled=False):
+        """ Load a matrix written by `save`, its arrays are memory-mapped by default. `scaled`
+            tells whether it was saved with scale factors (float16 and int8 values). """
+        scales = '{}.scales.npy'.format(prefix)
+        return cls(shape=shape, scales=np.load(scales, mmap_mode=mmap_mode) if scaled else None,
+                   **{name: np.load('{}.{}.npy'.format(prefix, name), mmap_mode=mmap_mode)
+                      for name in cls.ARRAYS})
+
+    @classmethod
+    def from_coordinates(cls, rows, columns, values, shape):
+        """ Build a matrix from (row, column, value) triplets given in any order. """
+        rows, columns = np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64)
+        order = np.lexsort((columns, rows))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=shape[0]))))
+        return cls(indptr, columns[order], np.asarray(values, dtype=np.float64)[order], shape)
+
+    @classmethod
+    def from_rows(cls, rows, width):
+        """ Build a matrix from a list of {column: value} dicts, one per row. """
+        coordinates = [(i, column, value) for (i, row) in enumerate(rows)
+                       for (column, value) in row.items()]
+        return cls.from_coordinates([c[0] for c in coordinates], [c[1] for c in coordinates],
+                                    [c[2] for c in coordinates], (len(rows), width))
+
+    def astype(self, dtype):
+        """ Return the matrix stored with another type of values. Converting to int8 maps the
+            biggest absolute value of each row to 127, converting to float16 maps it to 1 so that
+            no value overflows the type (its biggest value is 65504). """
+        if dtype == self.dtype:
+            return self
+        values = self.values()
+        scales = None
+        if dtype in self.SCALED:
+            scales = np.zeros(self.shape[0], dtype=np.float32)
+            np.maximum.at(scales, self.row_ids, np.abs(values) / self.SCALED[dtype])
+            values = values / np.where(scales > 0, scales, 1)[self.row_ids]
+            if dtype == 'int8':
+                values = np.rint(values)
+        return SparseMatrix(self.indptr, self.indices, values.astype(dtype), self.shape,
+                            self.row_ids, scales)
+
+    def values(self, start=None, end=None):
+        """ Actual values of the stored elements `start` to `end`, whatever their storage. """
+        data = self.data[start:end]
+        if self.scales is None:
+            return data
+        return data * self.scales[self.row_ids[start:end]]
+
+    def row(self, i):
+        """ Return the stored columns and values of row `i`. """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.values(start, end)
+
+    def dense_row(self, i):
+        vector = np.zeros(self.shape[1])
+        columns, values = self.row(i)
+        vector[columns] = values
+        return vector
+
+    def dense_rows(self, start, end, dtype=np.float64):
+        """ Return rows `start` to `end` (excluded) as a dense 2D array. """
+        end = min(end, self.shape[0])
+        rv = np.zeros((end - start, self.shape[1]), dtype=dtype)
+        first, last = self.indptr[start], self.indptr[end]
+        rv[self.row_ids[first:last] - start, self.indices[first:last]] = \
+            self.values(first, last)
+        return rv
+
+    def dot(self, other, buffer_size=2 ** 22):
+        """ Sparse matrix × dense vector product, returns one value per row. A dense matrix is
+            multiplied by blocks of columns, the products of the stored values with a block are
+            held in `buffer_size` values and summed row by row. Products are computed in the
+            storage type (float32 for float16 and int8 values), scaled rows are scaled once
+            summed. """
+        if self.dtype != 'float64':
+            other = other.astype(np.float32)
+        if other.ndim == 1:
+            rv = np.bincount(self.row_ids, weights=self.data * other[self.indices],
+                             minlength=self.shape[0])
+        else:
+            rv = np.zeros((self.shape[0], other.shape[1]),
+                          dtype=np.result_type(self.data, other))
+            step = max(1, buffer_size // max(1, len(self.data)))
+            # reduceat needs the first value of each row, empty rows are left to zero
+            filled = np.diff(self.indptr) > 0
+            starts = self.indptr[:-1][filled]
+            for j in range(0, other.shape[1] if len(self.data) else 0, step):
+                products = self.data[:, None] * other[self.indices, j:j + step]
+                rv[filled, j:j + step] = np.add.reduceat(products, starts, axis=0)
+        return rv if self.scales is None else (rv.T * self.scales).T
+
+    def take_rows(self, rows):
+        """ Return a matrix made of the given rows only. """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, lengths = self.indptr[rows], np.diff(self.indptr)[rows]
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return SparseMatrix(indptr, self.indices[positions], self.data[positions],
+                            (len(rows), self.shape[1]),
+                            scales=None if self.scales is None else self.scales[rows])
+
+    def row_norms(self):
+        return np.sqrt(np.bincount(self.row_ids, weights=self.values().astype(np.float64) ** 2,
+                                   minlength=self.shape[0]))
+
+    def row_max(self):
+        rv = np.zeros(self.shape[0])
+        np.maximum.at(rv, self.row_ids, self.values())
+        return rv
+
+    def scale_rows(self, factors):
+        """ Return a float64 copy of the matrix with each row multiplied by its factor. """
+        return SparseMatrix(self.indptr, self.indices,
+                            self.values().astype(np.float64) * factors[self.row_ids], self.shape,
+                            self.row_ids)
+
+    def splice(self, removed, rows, width):
+        """ Return a copy of the matrix without the `removed` rows, with `rows` ({column: value}
+            dicts) appended at the end and `width` columns. """
+        keep = np.ones(self.shape[0], dtype=bool)
+        keep[list(removed)] = False
+        kept_values = keep[self.row_ids]
+        added = SparseMatrix.from_rows(rows, width).astype(self.dtype)
+        indptr = np.concatenate(([0], np.cumsum(np.concatenate((
+            np.diff(self.indptr)[keep], np.diff(added.indptr))))))
+        return SparseMatrix(indptr, np.concatenate((self.indices[kept_values], added.indices)),
+                            np.concatenate((self.data[kept_values], added.data)),
+                            (int(keep.sum()) + len(rows), width),
+                            scales=None if self.scales is None else
+                            np.concatenate((self.scales[keep], added.scales)))
+
+    def transpose(self):
+        return SparseMatrix.from_coordinates(self.indices, self.row_ids, self.values(),
+                                             (self.shape[1], self.shape[0]))
+
+
+# ----------------------------------------------------------------------------------- inverted index
+class InvertedIndex:
+    """ Maps each term to its postings: the ids of the documents containing it along with the
+        number of occurrences in each of them. Document frequencies are the postings sizes.
+
+        Terms are interned, so that the indexes of a process share the strings of their common
+        vocabulary. """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        # term counts of each document, needed to remove it
+        self.documents = {}
+        # (number of documents, {term: df}) of a larger collection this index is part of
+        self.statistics = None
+
+    @property
+    def number_of_documents(self):
+        return len(self.documents)
+
+    def add(self, doc_id, tokens):
+        counts = self.documents[doc_id] = Counter({
+            intern(term) if isinstance(term, str) else term: count
+            for (term, count) in Counter(tokens).items()})
+        for term, count in counts.items():
+            self.postings[term][doc_id] = count
+
+    def remove(self, doc_id):
+        for term in self.documents.pop(doc_id):
+            del self.postings[term][doc_id]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def df(self, term):
+        return len(self.postings.get(term, ()))
+
+    def idf(self, term):
+        """ Inverse document frequency of a term, in the whole collection when `statistics` are
+            given (terms they do not know count the documents of the index). """
+        if self.statistics is None:
+            return self.number_of_documents / self.df(term)
+        documents, frequencies = self.statistics
+        return documents / frequencies.get(term, self.df(term))
+
+    def vocabulary(self):
+        """ Every term of the index, sorted so that it does not depend on the hash seed. """
+        return sorted(self.postings)
+
+
+# ------------------------------------------------------------------------------- approximate search
+class LshIndex:
+    """ Random hyperplane (SimHash) locality sensitive hashing. In each table, a vector is hashed
+        to the signs of its projections on `bits` random hyperplanes, so that vectors with a small
+        angle share a bucket with a high probability. More bits make smaller buckets (faster, less
+        recall), more tables give more chances to meet the neighbours (slower, more recall). """
+
+    def __init__(self, vectors, tables=8, bits=16, seed=0):
+        self.tables, self.bits = tables, bits
+        self.planes = np.random.RandomState(seed).standard_normal(
+            (vectors.shape[1], tables * bits)).astype(np.float32)
+        keys = self.__keys(vectors.dot(self.planes))
+        # one {key: rows} dict per table
+        self.buckets = []
+        for table in range(tables):
+            order = np.argsort(keys[:, table], kind='stable')
+            values, starts = np.unique(keys[order, table], return_index=True)
+            self.buckets.append(dict(zip(values.tolist(), np.split(order, starts[1:]))))
+
+    def __keys(self, projections):
+        signs = (projections > 0).reshape(len(projections), self.tables, self.bits)
+        return signs.dot(1 << np.arange(self.bits, dtype=np.int64))
+
+    def candidates(self, columns, values):
+        """ Rows sharing at least one bucket with a sparse vector. """
+        keys = self.__keys(values.dot(self.planes[columns])[None])[0]
+        found = [self.buckets[table].get(key) for (table, key) in enumerate(keys.tolist())]
+        return np.unique(np.concatenate([rows for rows in found if rows is not None] +
+                                        [np.zeros(0, dtype=np.int64)]))
+
+
+class IvfIndex:
+    """ Inverted file index: normalized vectors are clustered with a spherical mini-batch k-means,
+        each course is listed under its closest centroid. A query only scores the courses listed
+        under the `nprobe` centroids closest to it. """
+
+    def __init__(self, centroids, assignments):
+        self.centroids = centroids
+        self.assignments = assignments
+        order = np.argsort(assignments, kind='stable')
+        starts = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        self.lists = [order[start:end] for (start, end) in zip(starts[:-1], starts[1:])]
+
+    @classmethod
+    def build(cls, normalized, clusters, batch_size=256, iterations=100, seed=0):
+        """ Cluster the rows of a matrix of normalized vectors, see Sculley, "Web-scale k-means
+            clustering" (2010). Each batch moves its centroids toward the mean of their new
+            members, with a learning rate decreasing as centroids gather members. """
+        random = np.random.RandomState(seed)
+        size = normalized.shape[0]
+        clusters = min(clusters, size)
+        centroids = normalized.take_rows(random.choice(size, clusters, replace=False)) \
+            .dense_rows(0, clusters, dtype=np.float32)
+        counts = np.zeros(clusters)
+        sums = np.zeros_like(centroids)
+        for _ in range(iterations):
+            batch = normalized.take_rows(random.choice(size, min(batch_size, size),
+                                                       replace=False))
+            nearest = np.argmax(batch.dot(centroids.T), axis=1)
+            members = np.bincount(nearest, minlength=clusters)
+            # the stored values of each member are added to the sum of its centroid
+            sums.fill(0)
+            np.add.at(sums, (nearest[batch.row_ids], batch.indices), batch.values())
+            moved = members > 0
+            counts[moved] += members[moved]
+            rate = (members[moved] / counts[moved])[:, None]
+            centroids[moved] = (1 - rate) * centroids[moved] + rate * sums[moved] / \
+                members[moved][:, None]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1), 1e-12)[:, None]
+        # rows are assigned block by block, to never hold every similarity at once
+        assignments = np.concatenate([
+            np.argmax(normalized.take_rows(np.arange(start, min(start + batch_size, size)))
+                      .dot(centroids.T), axis=1)
+            for start in range(0, size, batch_size)])
+        return cls(centroids, assignments)
+
+    def save(self, prefix):
+        np.save(prefix + '.centroids.npy', self.centroids)
+        np.save(prefix + '.assignments.npy', self.assignments)
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(np.load(prefix + '.centroids.npy', mmap_mode='r'),
+                   np.load(prefix + '.assignments.npy'))
+
+    def candidates(self, columns, values, nprobe):
+        """ Rows listed under the `nprobe` centroids closest to a sparse vector. """
+        closest = np.argsort(-self.centroids[:, columns].dot(values), kind='stable')[:nprobe]
+        return np.concatenate([self.lists[cluster] for cluster in closest] +
+                              [np.zeros(0, dtype=np.int64)])
+
+
+class LsaIndex:
+    """ Latent semantic analysis: normalized vectors are projected on their `dimensions` first
+        singular vectors, giving dense float32 embeddings whose dot products approximate the
+        cosines. """
+
+    def __init__(self, components, embeddings):
+        # (dimensions × words) projection, and one normalized embedding per row
+        self.components = components
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, normalized, transposed, dimensions=128, oversampling=10,
+              power_iterations=2, seed=0):
+        """ Randomized truncated SVD of a sparse matrix given with its transpose, see Halko,
+            Martinsson and Tropp, "Finding structure with randomness" (2011). """
+        size, width = normalized.shape
+        dimensions = min(dimensions, size, width)
+        samples = min(dimensions + oversampling, size, width)
+        random = np.random.RandomState(seed)
+        # orthonormal basis of the range of the matrix, refined by power iterations
+        basis, _ = np.linalg.qr(normalized.dot(random.standard_normal((width, samples))))
+        for _ in range(power_iterations):
+            basis, _ = np.linalg.qr(transposed.dot(basis))
+            basis, _ = np.linalg.qr(normalized.dot(basis))
+        _, _, right = np.linalg.svd(transposed.dot(basis).T, full_matrices=False)
+        components = np.ascontiguousarray(right[:dimensions], dtype=np.float32)
+        return cls(components, cls.normalize(normalized.dot(components.T)))
+
+    @staticmethod
+    def normalize(embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1), 1e-12)[:, None]
+
+    def save(self, prefix):
+        np.save(prefix + '.components.npy', self.components)
+        np.save(prefix + '.embeddings.npy', self.embeddings)
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(np.load(prefix + '.components.npy', mmap_mode='r'),
+                   np.load(prefix + '.embeddings.npy', mmap_mode='r'))
+
+
+# ------------------------------------------------------------------------------------------ scorers
+class Bm25Index:
+    """ Okapi BM25 weight of every posting, idf · tf·(k1 + 1) / (tf + k1·(1 - b + b·|d| / avgdl))
+        where idf = log(1 + (N - df + .5) / (df + .5)). Document lengths, their average and the
+        idf are computed once, a query then only sums the postings of its terms. """
+
+    def __init__(self, postings, lengths, idf, parameters):
+        # (words × documents) weights, one row of postings per term
+        self.postings = postings
+        self.lengths = lengths
+        self.idf = idf
+        self.parameters = parameters
+
+    @classmethod
+    def build(cls, counts, k1=1.2, b=.75):
+        """ Weights from a (documents × words) matrix of term counts. """
+        size, width = counts.shape
+        tf = counts.values().astype(np.float64)
+        lengths = np.bincount(counts.row_ids, weights=tf, minlength=size)
+        df = np.bincount(counts.indices, minlength=width)
+        idf = np.log1p((size - df + .5) / (df + .5))
+        normalization = k1 * (1 - b + b * lengths / max(lengths.mean(), 1e-12))
+        weights = idf[counts.indices] * tf * (k1 + 1) / (tf + normalization[counts.row_ids])
+        return cls(SparseMatrix.from_coordinates(counts.indices, counts.row_ids, weights,
+                                                 (width, size)),
+                   lengths, idf, np.array([k1, b]))
+
+    def scores(self, columns, counts):
+        """ BM25 score of every document for a query given as its terms and their counts. """
+        rv = np.zeros(self.postings.shape[1])
+        for column, count in zip(columns, counts):
+            rows, weights = self.postings.row(column)
+            rv[rows] += count * weights
+        return rv
+
+    def save(self, prefix):
+        self.postings.save(prefix + '.postings')
+        np.save(prefix + '.lengths.npy', self.lengths)
+        np.save(prefix + '.idf.npy', self.idf)
+        np.save(prefix + '.parameters.npy', self.parameters)
+
+    @classmethod
+    def load(cls, prefix, shape):
+        return cls(SparseMatrix.load(prefix + '.postings', shape),
+                   np.load(prefix + '.lengths.npy', mmap_mode='r'),
+                   np.load(prefix + '.idf.npy', mmap_mode='r'),
+                   np.load(prefix + '.parameters.npy'))
+
 
 # ------------------------------------------------------------------------------------ search engine
+class StaleSnapshotError(Exception):
+    """ Raised when the course files changed since an index snapshot was saved. """
+
+
+def file_signature(path):
+    """ What is recorded about a course file to detect that a snapshot is stale. """
+    stat_result = stat(path)
+    return [abspath(path), stat_result.st_mtime_ns, stat_result.st_size]
+
+
+CosineCacheInfo = namedtuple('CosineCacheInfo', 'hits misses evictions entries size maxsize')
+
+
+class CosineCache:
+    """ Bounded LRU cache of the cosines of pairs of courses and of score vectors (the cosines of
+        one course with every course, see `SearchEngine.scores`). A pair is answered from the score
+        vector of one of its courses when there is one. Once the estimated size of the entries
+        exceeds `maxsize` bytes, the least recently used ones are evicted. """
+
+    # estimated size of a pair entry: key tuple, float and the node of the ordered dict
+    PAIR_BYTES = 160
+    VECTOR_OVERHEAD = 200
+
+    def __init__(self, maxsize=16 * 2 ** 20):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(acr_a, acr_b):
+        return (acr_a, acr_b) if acr_a <= acr_b else (acr_b, acr_a)
+
+    def __contains__(self, pair):
+        return self.key(*pair) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cosine(self, acr_a, acr_b, row_a, row_b):
+        """ Cached cosine of a pair, None on a miss. `row_a` and `row_b` index the score vectors of
+            `acr_a` and `acr_b`. """
+        for acronym, row in ((acr_a, row_b), (acr_b, row_a)):
+            if acronym in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(acronym)
+                return float(self.entries[acronym][row])
+        key = self.key(acr_a, acr_b)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+
+    def scores(self, acronym):
+        """ Cached score vector of a course, None on a miss. """
+        if acronym in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(acronym)
+            return self.entries[acronym]
+        self.misses += 1
+
+    def add_cosine(self, acr_a, acr_b, cosine):
+        self.__add(self.key(acr_a, acr_b), cosine, self.PAIR_BYTES)
+
+    def add_scores(self, acronym, scores):
+        scores.flags.writeable = False
+        self.__add(acronym, scores, scores.nbytes + self.VECTOR_OVERHEAD)
+
+    def __add(self, key, value, size):
+        if key in self.entries:
+            self.__pop(key)
+        if size > self.maxsize:
+            return
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.maxsize:
+            self.__pop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def __pop(self, key):
+        value = self.entries.pop(key)
+        self.size -= self.PAIR_BYTES if isinstance(key, tuple) else \
+            value.nbytes + self.VECTOR_OVERHEAD
+
+    def forget(self, acronym):
+        """ Drop the cosines of an edited course, and every score vector since they all have a
+            score for it. """
+        for key in [key for key in self.entries
+                    if not isinstance(key, tuple) or acronym in key]:
+            self.__pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def info(self):
+        return CosineCacheInfo(self.hits, self.misses, self.evictions, len(self.entries),
+                               self.size, self.maxsize)
+
+
+class DocumentStore:
+    """ Where the title and description of each course are read from: its file, or its record in
+        a catalog. They are read on demand, the last ones are kept in a LRU cache of `cache_size`
+        courses. """
+
+    def __init__(self, catalog=None, cache_size=256):
+        self.catalog = catalog
+        # file (or catalog file) of each course
+        self.sources = {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, acronym):
+        return acronym in self.sources
+
+    def add(self, acronym, source):
+        self.sources[acronym] = source
+        self.cache.pop(acronym, None)
+
+    def remove(self, acronym):
+        self.sources.pop(acronym, None)
+        self.cache.pop(acronym, None)
+
+    def get(self, acronym):
+        """ Title and description of a course, None if it has no source. """
+        if acronym in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(acronym)
+            return self.cache[acronym]
+        if acronym not in self.sources:
+            return None
+        self.misses += 1
+        if self.catalog is not None and self.sources[acronym] == self.catalog.path:
+            course = self.catalog.record(acronym)[1:]
+        else:
+            course = parse_course(self.sources[acronym])
+        self.cache[acronym] = course
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return course
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.cache_size, len(self.cache))
+
+
 class SearchEngine:
-    files = {}
-    vectors = {}
+    SNAPSHOT_VERSION = 6
+    # prefixes of the files of a snapshot, those of a previous save are removed first
+    SNAPSHOT_PARTS = ('vectors', 'term_postings', 'vocabulary', 'ivf', 'lsa', 'bm25')
+    # idf weights are only refreshed once the number of edits reaches this ratio of the catalog
+    IDF_REFRESH_RATIO = .1
+
+    # number of chunks given to each worker process by the parallel ingestion, of at most
+    # CHUNK_SIZE courses, and number of chunks of each worker being tokenized at once
+    CHUNKS_PER_WORKER = 4
+    CHUNK_SIZE = 1024
+    RUNNING_CHUNKS = 2
+
+    # memory ceiling of the cosine cache, in bytes
+    COSINE_CACHE_SIZE = 16 * 2 ** 20
+
+    # scoring of the searches: cosine of the tf*idf vectors, or Okapi BM25 (see Bm25Index)
+    SCORERS = ('cosine', 'bm25')
+
+    def __init__(self, files, language='french', workers=1, dtype='float64', hash_size=None,
+                 bigrams=False):
+        """ Index course files. With more than one worker, files are read and tokenized by a pool
+            of processes, the resulting index is the same as the one of a serial build.
+
+            `dtype` is the storage type of the vectors: 'float64', 'float32', 'float16' or 'int8'
+            (with a scale factor per vector). Scores are computed in that representation, norms
+            are kept in float32 unless vectors are float64.
+
+            With a `hash_size`, terms are hashed to that many columns instead of being numbered by
+            a vocabulary (see FeatureHasher). `bigrams` adds the pairs of consecutive words to the
+            terms. """
+        if dtype not in SparseMatrix.DTYPES:
+            raise ValueError('Unsupported storage type', dtype)
+        self.language = language
+        self.dtype = dtype
+        self.hasher = FeatureHasher(hash_size, bigrams)
+        self.profiler = Profiler()
+        self.parser = Parser(language=language, default_remove_stopwords=True, default_stem=True)
+        # courses can also come from a single catalog file, see Catalog
+        self.documents = DocumentStore(files if isinstance(files, Catalog) else None)
+        self.index = InvertedIndex()
+        # (number of documents, {term: df}) of a larger collection, see set_statistics
+        self.statistics = None
+        # retrieve file contents and tokenize it, a single pass gives every document frequency,
+        # only the term counts of the index are kept
+        for course, tokens in self.__tokenize(files, workers):
+            with self.profiler.stage('document frequency'):
+                if isinstance(course, str):
+                    self.__add(basename(course)[:-4], course, tokens)
+                else:
+                    self.__add(course[0], self.documents.catalog.path, tokens)
+        self.__refresh()
+
+    def __tokenize(self, courses, workers):
+        """ Generate (course, tokens) pairs. Serially, courses (files or catalog records) are read
+            one at a time; the process pool is given them by chunks, a few at a time, and the
+            pairs of a chunk are generated as soon as it is tokenized. """
+        workers = cpu_count() if workers is None else workers
+        if workers <= 1:
+            for course in courses:
+                yield course, tokenize_course(self.parser, course, self.profiler)
+            return
+        # imported here, a serial build does not pay for multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        size = max(1, min(self.CHUNK_SIZE,
+                          -(-len(courses) // (workers * self.CHUNKS_PER_WORKER))))
+        courses = iter(courses)
+        running = deque()
+        with ProcessPoolExecutor(workers) as executor:
+            for chunk in chain(iter(lambda: list(islice(courses, size)), []), [None]):
+                if chunk is not None:
+                    running.append((chunk, executor.submit(_tokenize_courses, chunk,
+                                                           self.language)))
+                # chunks are merged in their order, so the index does not depend on the scheduling
+                while running and (chunk is None or
+                                   len(running) > workers * self.RUNNING_CHUNKS):
+                    done, future = running.popleft()
+                    with self.profiler.stage('parsing and tokenizing (workers)'):
+                        tokens = future.result()
+                    yield from zip(done, tokens)
+
+    def __parse(self, file):
+        return self.__add(basename(file)[:-4], file,
+                          tokenize_course(self.parser, file, self.profiler))
+
+    def __add(self, acronym, source, tokens):
+        self.documents.add(acronym, source)
+        self.index.add(acronym, self.hasher.terms(tokens))
+        return acronym
+
+    def __refresh(self):
+        """ Derive idf weights, vectors and everything used for scoring from the index. The index
+            is then dropped, as in a loaded snapshot: the next edit rebuilds it from the counts. """
+        with self.profiler.stage('vectorization'):
+            self.__vectorize()
+        self.index = None
+        self.__reset_edits()
+        self.__reset_cosines()
+
+    def __vectorize(self):
+        # rows of the matrix, in a stable order
+        self.acronyms = sorted(self.index.documents)
+        self.rows = {acronym: row for (row, acronym) in enumerate(self.acronyms)}
+        if self.hasher.size:
+            # hashed terms are their own column, those of the catalog have a nonzero idf
+            self.words_index = None
+            self.idf = np.zeros(self.width)
+            for word in self.index.vocabulary():
+                self.idf[word] = self.index.idf(word)
+        else:
+            self.words_index = {word: (column, self.index.idf(word))
+                                for (column, word) in enumerate(self.index.vocabulary())}
+        self.__derive(self.__matrix())
+
+    @property
+    def width(self):
+        """ Number of columns of the vectors. """
+        return self.hasher.size or len(self.words_index)
+
+    def __column(self, term):
+        """ Column of a term, None if no course contains it. """
+        if self.words_index is None:
+            return term if self.idf[term] else None
+        entry = self.words_index.get(term)
+        return None if entry is None else entry[0]
+
+    def __terms(self):
+        """ Function giving the term of a column. """
+        if self.words_index is None:
+            return int
+        return {column: word for (word, (column, _)) in self.words_index.items()}.__getitem__
+
+    def __derive(self, counts):
+        """ Derive the tf*idf vectors from a matrix of term counts, and everything used for
+            scoring from the vectors. """
+        if self.words_index is not None:
+            self.idf = np.zeros(self.width)
+            for column, idf in self.words_index.values():
+                self.idf[column] = idf
+        # exact counts of the stored values of the vectors, that quantized values cannot give back
+        self.counts = counts.values().astype(np.int32)
+        self.vectors = SparseMatrix(counts.indptr, counts.indices,
+                                    self.counts * self.idf[counts.indices], counts.shape,
+                                    counts.row_ids)
+        # norms are those of the stored vectors, so that a course keeps a cosine of 1 with itself
+        self.vectors = self.vectors.astype(self.dtype)
+        self.norms = self.vectors.row_norms().astype(np.float64 if self.dtype == 'float64'
+                                                     else np.float32)
+        # postings of the normalized vectors, one row per word, used to score free text queries
+        self.term_postings = self.vectors.scale_rows(1 / self.norms).transpose()
+        self.max_weights = self.term_postings.row_max()
+        self.term_postings = self.term_postings.astype(self.dtype)
+        self.__reset_approximate()
+
+    def __reset_approximate(self):
+        # indexes of the approximate searches, built on demand as they depend on the vectors
+        self.lsh = None
+        self.ivf = None
+        self.lsa = None
+        self.bm25 = None
+
+    def __reset_edits(self):
+        # courses added, updated or removed since the vectors were last computed
+        self.__pending = set()
+        self.__edits = 0
+
+    def __reset_cosines(self):
+        # cosine of every pair of courses, memory-mapped from a file written by all_pairs
+        self.pairs = None
+        self.cosines = CosineCache(self.COSINE_CACHE_SIZE)
+
+    # ------------------------------------------------------------------------------ catalog edits
+    def add_course(self, file):
+        """ Index a new course file. Like every edit, the vectors are only updated on the next
+            query, and idf weights once enough edits were made (see IDF_REFRESH_RATIO). """
+        self.__ensure_index()
+        if basename(file)[:-4] in self.index.documents:
+            raise ValueError('Course already indexed', basename(file)[:-4])
+        self.__edited(self.__parse(file))
+
+    def update_course(self, file):
+        """ Index again a course file whose content changed. """
+        # read first: a course that cannot be read stays indexed as it was
+        tokens = tokenize_course(self.parser, file, self.profiler)
+        self.__ensure_index()
+        self.index.remove(basename(file)[:-4])
+        self.__edited(self.__add(basename(file)[:-4], file, tokens))
+
+    def add_document(self, acronym, stream, title=''):
+        """ Index a document read from a file-like object. Its tokens are counted as they are
+            streamed out of `Parser.iter_tokens`, its text is never kept. """
+        self.__ensure_index()
+        if acronym in self.index.documents:
+            raise ValueError('Course already indexed', acronym)
+        self.index.add(acronym, self.hasher.terms(chain(self.parser.tokenize(title),
+                                                        self.parser.iter_tokens(stream))))
+        self.__edited(acronym)
+
+    def remove_course(self, acronym):
+        self.__ensure_index()
+        self.index.remove(acronym)
+        self.documents.remove(acronym)
+        self.__edited(acronym)
+
+    def __edited(self, acronym):
+        self.__pending.add(acronym)
+        self.__edits += 1
+        self.cosines.forget(acronym)
+
+    def __ensure_index(self):
+        """ A loaded snapshot has no index, it is rebuilt from the term counts before any edit. """
+        if self.index is not None:
+            return
+        self.index = InvertedIndex()
+        self.index.statistics = self.statistics
+        term = self.__terms()
+        counts = self.__term_counts()
+        for row, acronym in enumerate(self.acronyms):
+            columns, values = counts.row(row)
+            self.index.add(acronym, Counter({term(column): int(count)
+                                             for (column, count) in zip(columns, values)}))
+
+    def __term_counts(self):
+        """ Matrix of the term counts, stored like the vectors. """
+        return SparseMatrix(self.vectors.indptr, self.vectors.indices, self.counts,
+                            self.vectors.shape, self.vectors.row_ids)
+
+    def __apply_edits(self):
+        """ Bring the vectors up to date with the index before answering a query. Edited rows are
+            replaced using the current idf weights, new words get a new column. Every weight is
+            computed again once the edits reach IDF_REFRESH_RATIO of the catalog. """
+        if not self.__pending:
+            return
+        if self.__edits >= self.IDF_REFRESH_RATIO * self.index.number_of_documents:
+            return self.__refresh()
+        added = sorted(acronym for acronym in self.__pending if acronym in self.index.documents)
+        for acronym in added:
+            for word in self.index.documents[acronym]:
+                if self.__column(word) is not None:
+                    continue
+                if self.words_index is None:
+                    self.idf[word] = self.index.idf(word)
+                else:
+                    self.words_index[word] = (len(self.words_index), self.index.idf(word))
+        counts = self.__term_counts().splice(
+            [self.rows[acronym] for acronym in self.__pending if acronym in self.rows],
+            [{self.__column(word): count
+              for (word, count) in self.index.documents[acronym].items()} for acronym in added],
+            self.width)
+        self.acronyms = [acronym for acronym in self.acronyms
+                         if acronym not in self.__pending] + added
+        self.rows = {acronym: row for (row, acronym) in enumerate(self.acronyms)}
+        self.__derive(counts)
+        self.__pending = set()
+        # the cosines of edited courses were already forgotten, but the rows of all_pairs moved
+        self.pairs = None
+
+    # --------------------------------------------------------------------------------- snapshots
+    def save(self, path):
+        """ Write the index to the `path` directory: numpy arrays that `load` memory-maps, and a
+            manifest with the vocabulary, the courses and the signature of their files. The
+            manifest lists the optional parts written, `load` reads nothing else. """
+        self.__apply_edits()
+        makedirs(path, exist_ok=True)
+        for part in self.SNAPSHOT_PARTS:
+            for file in glob(join(path, part + '.*')):
+                remove(file)
+        parts = ['{}.scales'.format(name) for name in ('vectors', 'term_postings')
+                 if getattr(self, name).scales is not None]
+        parts += [name for name in ('ivf', 'lsa', 'bm25') if getattr(self, name) is not None]
+        self.vectors.save(join(path, 'vectors'))
+        self.term_postings.save(join(path, 'term_postings'))
+        np.save(join(path, 'counts.npy'), self.counts)
+        np.save(join(path, 'norms.npy'), self.norms)
+        np.save(join(path, 'max_weights.npy'), self.max_weights)
+        np.save(join(path, 'idf.npy'), self.idf)
+        if self.words_index is not None:
+            vocabulary = sorted(self.words_index, key=lambda word: self.words_index[word][0])
+            with open(join(path, 'vocabulary.txt'), 'w') as stream:
+                stream.write('\n'.join(vocabulary))
+        self.parser.save_stems(join(path, 'stems.tsv'))
+        if self.ivf is not None:
+            self.ivf.save(join(path, 'ivf'))
+        if self.lsa is not None:
+            self.lsa.save(join(path, 'lsa'))
+        if self.bm25 is not None:
+            self.bm25.save(join(path, 'bm25'))
+        catalog, sources = self.documents.catalog, self.documents.sources
+        if catalog is not None:
+            # offsets of the records, so that the catalog is not scanned again
+            np.save(join(path, 'catalog.npy'), np.array(
+                [catalog.offsets.get(acronym, (-1, -1)) for acronym in self.acronyms],
+                dtype=np.int64).reshape(-1, 2))
+        with open(join(path, 'manifest.json'), 'w') as stream:
+            json.dump({'version': self.SNAPSHOT_VERSION, 'language': self.language,
+                       'dtype': self.dtype, 'hash_size': self.hasher.size,
+                       'bigrams': self.hasher.bigrams,
+                       'catalog': None if catalog is None else abspath(catalog.path),
+                       'acronyms': self.acronyms, 'shape': self.vectors.shape, 'parts': parts,
+                       'sources': [[acronym] + file_signature(sources[acronym])
+                                   for acronym in self.acronyms if acronym in sources]},
+                      stream)
+
+    @classmethod
+    def load(cls, path, files=None, dtype=None, hasher=None):
+        """ Open a snapshot written by `save` without reading any course file. Raise
+            StaleSnapshotError if a recorded file changed, if `files` are not the files the
+            snapshot was built from, or if its vectors are not stored as `dtype` or its terms not
+            made by `hasher` (when given). """
+        with open(join(path, 'manifest.json')) as stream:
+            manifest = json.load(stream)
+        if manifest['version'] != cls.SNAPSHOT_VERSION:
+            raise StaleSnapshotError('Unsupported snapshot version', path, manifest['version'])
+        if dtype is not None and manifest['dtype'] != dtype:
+            raise StaleSnapshotError('Snapshot was built with another storage type', path,
+                                     manifest['dtype'])
+        if hasher is not None and (manifest['hash_size'], manifest['bigrams']) != \
+                (hasher.size, hasher.bigrams):
+            raise StaleSnapshotError('Snapshot was built with other terms', path)
+        recorded = {source[1]: source[2:] for source in manifest['sources']}
+        if isinstance(files, Catalog):
+            files = [files.path]
+        if files is not None and set(map(abspath, files)) != set(recorded):
+            raise StaleSnapshotError('Snapshot was built from other files', path)
+        for file, signature in recorded.items():
+            if not isfile(file) or file_signature(file)[1:] != signature:
+                raise StaleSnapshotError('File changed since the snapshot was saved', path, file)
+        engine = cls.__new__(cls)
+        engine.profiler = Profiler()
+        engine.language = manifest['language']
+        engine.dtype = manifest['dtype']
+        engine.hasher = FeatureHasher(manifest['hash_size'], manifest['bigrams'])
+        engine.parser = Parser(language=engine.language, default_remove_stopwords=True,
+                               default_stem=True, stem_table=join(path, 'stems.tsv'))
+        engine.acronyms = manifest['acronyms']
+        engine.rows = {acronym: row for (row, acronym) in enumerate(engine.acronyms)}
+        engine.index = None
+        engine.statistics = None
+        catalog = None
+        if manifest['catalog'] is not None:
+            offsets = np.load(join(path, 'catalog.npy'))
+            catalog = Catalog(manifest['catalog'], OrderedDict(
+                (acronym, tuple(map(int, offsets[row])))
+                for (row, acronym) in enumerate(engine.acronyms) if offsets[row, 0] >= 0))
+        engine.documents = DocumentStore(catalog)
+        for source in manifest['sources']:
+            engine.documents.add(source[0], source[1])
+        idf = np.load(join(path, 'idf.npy'))
+        engine.words_index = None
+        if not engine.hasher.size:
+            with open(join(path, 'vocabulary.txt')) as stream:
+                engine.words_index = {intern(word): (column, float(idf[column])) for (column, word)
+                                      in enumerate(stream.read().split('\n')) if word}
+        parts = set(manifest['parts'])
+        engine.vectors = SparseMatrix.load(join(path, 'vectors'), manifest['shape'],
+                                           scaled='vectors.scales' in parts)
+        engine.term_postings = SparseMatrix.load(join(path, 'term_postings'),
+                                                 manifest['shape'][::-1],
+                                                 scaled='term_postings.scales' in parts)
+        engine.counts = np.load(join(path, 'counts.npy'), mmap_mode='r')
+        engine.norms = np.load(join(path, 'norms.npy'), mmap_mode='r')
+        engine.max_weights = np.load(join(path, 'max_weights.npy'), mmap_mode='r')
+        engine.idf = idf
+        engine.__reset_approximate()
+        if 'ivf' in parts:
+            engine.ivf = IvfIndex.load(join(path, 'ivf'))
+        if 'lsa' in parts:
+            engine.lsa = LsaIndex.load(join(path, 'lsa'))
+        if 'bm25' in parts:
+            engine.bm25 = Bm25Index.load(join(path, 'bm25'), manifest['shape'][::-1])
+        engine.__reset_edits()
+        engine.__reset_cosines()
+        return engine
+
+    def course(self, acronym):
+        """ Title and original description of a course, read on demand from its file or its
+            catalog record (see DocumentStore). Documents added from a stream have none. """
+        return self.documents.get(acronym)
 
-    def __init__(self, files, language='french'):
+    def description(self, acronym):
+        course = self.course(acronym)
+        return None if course is None else course[1]
+
+    def __matrix(self):
+        """ Build the matrix of term counts from the postings of the inverted index. """
+        rows, columns, counts = [], [], []
+        for word, postings in self.index.postings.items():
+            column = self.__column(word)
+            for acronym, count in postings.items():
+                rows.append(self.rows[acronym])
+                columns.append(column)
+                counts.append(count)
+        return SparseMatrix.from_coordinates(rows, columns, counts,
+                                             (len(self.acronyms), self.width))
+
+    # ----------------------------------------------------------------------------------- scoring
+    def cosine(self, acr_a, acr_b):
+        """ Cosine between two courses, cached (see CosineCache). """
+        self.__apply_edits()
+        row_a, row_b = self.rows[acr_a], self.rows[acr_b]
+        if self.pairs is not None:
+            return float(self.pairs[row_a, row_b])
+        cosine = self.cosines.cosine(acr_a, acr_b, row_a, row_b)
+        if cosine is None:
+            columns, values = self.vectors.row(row_b)
+            dot = self.vectors.dense_row(row_a)[columns].dot(values)
+            cosine = float(dot / (self.norms[row_a] * self.norms[row_b]))
+            self.cosines.add_cosine(acr_a, acr_b, cosine)
+        return cosine
+
+    def cosine_cache_info(self):
+        """ Hits, misses, evictions, entries and size in bytes of the cosine cache. """
+        return self.cosines.info()
+
+    def scores(self, acronym):
+        """ Cosine between a course and every course of the engine, computed with a single
+            sparse matrix × vector product and cached. Values are ordered as `self.acronyms`,
+            the array is read-only. """
+        self.__apply_edits()
+        row = self.rows[acronym]
+        if self.pairs is not None:
+            return np.asarray(self.pairs[row], dtype=np.float64)
+        scores = self.cosines.scores(acronym)
+        if scores is None:
+            with self.profiler.stage('cosine'):
+                scores = self.vectors.dot(self.vectors.dense_row(row)) / \
+                    (self.norms * self.norms[row])
+            self.cosines.add_scores(acronym, scores)
+        return scores
+
+    def all_pairs(self, path, memory_budget=64 * 2 ** 20, lsa=False):
+        """ Compute the cosine of every pair of courses and write them to `path` as a memory-mapped
+            float32 .npy matrix, rows and columns following `self.acronyms`. Dense blocks of
+            normalized vectors are multiplied two by two, their size is chosen so that the two
+            blocks and their product fit in `memory_budget` bytes. With `lsa`, the LSA embeddings
+            are used instead of the vectors (see `build_lsa`). """
+        self.__apply_edits()
+        if lsa:
+            if self.lsa is None:
+                self.build_lsa()
+            size, width = self.lsa.embeddings.shape
+
+            def rows(start, end):
+                return self.lsa.embeddings[start:end]
+        else:
+            normalized = self.vectors.scale_rows(1 / self.norms)
+            size, width = normalized.shape
+
+            def rows(start, end):
+                return normalized.dense_rows(start, end, dtype=np.float32)
+        block = int(min(size, max(1, np.sqrt(width ** 2 + memory_budget / 4) - width)))
+        pairs = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(size, size))
+        for i in range(0, size, block):
+            block_i = rows(i, i + block)
+            for j in range(i, size, block):
+                block_j = block_i if i == j else rows(j, j + block)
+                tile = block_i.dot(block_j.T)
+                pairs[i:i + block, j:j + block] = tile
+                pairs[j:j + block, i:i + block] = tile.T
+        pairs.flush()
+        with open(path + '.acronyms', 'w') as stream:
+            stream.write('\n'.join(self.acronyms))
+        return pairs
+
+    def open_pairs(self, path):
+        """ Answer cosine lookups from a matrix written by `all_pairs`, memory-mapped read-only. """
+        self.__apply_edits()
+        with open(path + '.acronyms') as stream:
+            if stream.read().split('\n') != self.acronyms:
+                raise ValueError('Pairs file does not match the courses of the engine', path)
+        self.pairs = np.load(path, mmap_mode='r')
+        self.cosines.clear()
+
+    def search(self, acronym, sort=True, reverse_sort=True, k=None, scorer='cosine'):
+        """ Return the courses similar to `acronym` with their score. When `k` is given, only the
+            k best ones (the k worst if `reverse_sort` is false) are kept; they are selected with a
+            partial partition of the scores instead of a full sort. `scorer` is one of SCORERS,
+            with 'bm25' the terms of the course are the query. """
+        with self.profiler.stage('search'):
+            if scorer == 'cosine':
+                scores = self.scores(acronym)
+            else:
+                self.__apply_edits()
+                start, end = self.vectors.indptr[self.rows[acronym]:self.rows[acronym] + 2]
+                scores = self.__query(scorer, self.vectors.indices[start:end],
+                                      self.counts[start:end])
+            rows = np.delete(np.arange(len(self.acronyms)), self.rows[acronym])
+            return self.__rank(rows, scores[rows], sort, reverse_sort, k)
+
+    def search_many(self, acronyms, k=10, memory_budget=64 * 2 ** 20, scorer='cosine'):
+        """ `search` for several courses, yield (acronym, results) pairs in the order of
+            `acronyms`, which can be any iterable. Courses are taken by batches whose vectors are
+            stacked into a dense matrix, scored against every course with a single sparse matrix
+            product; a batch, its scores and the vectors fit in about `memory_budget` bytes. BM25
+            queries are scored one by one from the postings of their terms. """
+        if scorer != 'cosine':
+            yield from ((acronym, self.search(acronym, k=k, scorer=scorer))
+                        for acronym in acronyms)
+            return
+        self.__apply_edits()
+        size, width = self.vectors.shape
+        batch_size = max(1, int(memory_budget // (8 * (width + size))))
+        acronyms = iter(acronyms)
+        for batch in iter(lambda: list(islice(acronyms, batch_size)), []):
+            rows = np.array([self.rows[acronym] for acronym in batch])
+            with self.profiler.stage('search many'):
+                queries = self.vectors.take_rows(rows).dense_rows(0, len(rows)).T
+                scores = self.vectors.dot(queries) / np.outer(self.norms, self.norms[rows])
+            for j, (acronym, row) in enumerate(zip(batch, rows)):
+                others = np.delete(np.arange(size), row)
+                yield acronym, self.__rank(others, scores[others, j], k=k)
+
+    def stats(self):
+        """ Number of runs and total time of each stage of the indexing and of the searches, in
+            seconds. Stemming is part of tokenizing, it counts the words that were not in the
+            stem cache. Stages run by worker processes are only timed as a whole. """
+        rv = OrderedDict(self.profiler.stages)
+        if self.parser.stem_misses:
+            rv['stemming'] = StageStats(self.parser.stem_misses, self.parser.stem_time)
+        return rv
+
+    def __rank(self, rows, scores, sort=True, reverse_sort=True, k=None):
+        """ Turn the scores of some rows into search results, see `search`. """
+        keys = -scores if reverse_sort else scores
+        if k is not None and k < len(rows):
+            # keep the selection in catalog order, so that sort=False still matches it
+            selected = np.sort(np.argpartition(keys, k - 1)[:k]) if k > 0 else slice(0, 0)
+            rows, scores, keys = rows[selected], scores[selected], keys[selected]
+        if sort:
+            order = np.argsort(keys, kind='stable')
+            rows, scores = rows[order], scores[order]
+        return [(self.acronyms[row], float(score)) for (row, score) in zip(rows, scores)]
+
+    def __search_candidates(self, acronym, candidates, k):
+        """ Exact ranking of the candidate rows of an approximate search. """
+        row = self.rows[acronym]
+        candidates = candidates[candidates != row]
+        columns, values = self.vectors.row(row)
+        query = np.zeros(self.vectors.shape[1])
+        query[columns] = values
+        scores = self.vectors.take_rows(candidates).dot(query) / \
+            (self.norms[candidates] * self.norms[row])
+        return self.__rank(candidates, scores, k=k)
+
+    def build_lsh(self, tables=8, bits=16, seed=0):
+        """ Index the vectors for `search_lsh`, see LshIndex for the parameters. """
+        self.__apply_edits()
+        self.lsh = LshIndex(self.vectors, tables, bits, seed)
+
+    def search_lsh(self, acronym, k=10):
+        """ Approximate `search`: only courses sharing a LSH bucket with `acronym` are scored. """
+        self.__apply_edits()
+        if self.lsh is None:
+            self.build_lsh()
+        candidates = self.lsh.candidates(*self.vectors.row(self.rows[acronym]))
+        return self.__search_candidates(acronym, candidates, k)
+
+    def build_ivf(self, clusters=None, batch_size=256, iterations=100, seed=0):
+        """ Cluster the vectors for `search_ivf`, in about √(number of courses) clusters by
+            default. The clustering is saved along with the snapshot of the engine. """
+        self.__apply_edits()
+        clusters = clusters or max(1, int(np.sqrt(len(self.acronyms))))
+        self.ivf = IvfIndex.build(self.vectors.scale_rows(1 / self.norms), clusters, batch_size,
+                                  iterations, seed)
+
+    def search_ivf(self, acronym, k=10, nprobe=4):
+        """ Approximate `search`: only courses of the `nprobe` clusters closest to `acronym` are
+            scored. """
+        self.__apply_edits()
+        if self.ivf is None:
+            self.build_ivf()
+        row = self.rows[acronym]
+        columns, values = self.vectors.row(row)
+        candidates = self.ivf.candidates(columns, values / self.norms[row], nprobe)
+        return self.__search_candidates(acronym, candidates, k)
+
+    def build_lsa(self, dimensions=128, oversampling=10, power_iterations=2, seed=0):
+        """ Compute the `dimensions` LSA embeddings of the courses for `search_lsa`, they are saved
+            along with the snapshot of the engine. """
+        self.__apply_edits()
+        self.lsa = LsaIndex.build(self.vectors.scale_rows(1 / self.norms), self.term_postings,
+                                  dimensions, oversampling, power_iterations, seed)
+
+    def search_lsa(self, acronym, k=10):
+        """ Approximate `search` in the LSA space: a single (courses × dimensions) matrix × vector
+            product scores every course. """
+        self.__apply_edits()
+        if self.lsa is None:
+            self.build_lsa()
+        row = self.rows[acronym]
+        scores = self.lsa.embeddings.dot(self.lsa.embeddings[row]).astype(np.float64)
+        rows = np.delete(np.arange(len(self.acronyms)), row)
+        return self.__rank(rows, scores[rows], k=k)
+
+    def recall(self, approximate_search, acronyms=None, k=10):
+        """ Mean recall@k of an approximate search method (such as `search_lsh`) against the
+            exact `search`, over `acronyms` (every course by default). """
+        acronyms = self.acronyms if acronyms is None else acronyms
+        found = expected = 0
+        for acronym in acronyms:
+            exact = set(acr for (acr, _) in self.search(acronym, k=k))
+            found += len(exact.intersection(acr for (acr, _) in approximate_search(acronym, k=k)))
+            expected += len(exact)
+        return found / expected if expected else 1.
+
+    def build_bm25(self, k1=1.2, b=.75):
+        """ Compute the BM25 weights of the postings for the 'bm25' scorer, from the exact term
+            counts of the courses. They are saved along with the snapshot of the engine. """
+        self.__apply_edits()
+        self.bm25 = Bm25Index.build(self.__term_counts(), k1, b)
+
+    def document_frequencies(self):
+        """ Number of courses and document frequency of each term, see `set_statistics`. """
+        self.__apply_edits()
+        frequencies = np.bincount(self.vectors.indices, minlength=self.width)
+        term = self.__terms()
+        return len(self.acronyms), {term(column): int(frequencies[column])
+                                    for column in np.flatnonzero(frequencies)}
+
+    def set_statistics(self, documents, frequencies):
+        """ Weight terms with the idf of a larger collection, of `documents` courses and the
+            {term: df} `frequencies`, instead of the one of this engine: a shard then scores its
+            courses exactly as an engine of the whole collection would. """
+        self.statistics = (documents, frequencies)
+        self.__ensure_index()
+        self.index.statistics = self.statistics
+        self.__refresh()
+
+    def term_weights(self, acronym):
+        """ tf*idf weights of the terms of a course, as a {term: weight} dict. """
+        self.__apply_edits()
+        term = self.__terms()
+        columns, values = self.vectors.row(self.rows[acronym])
+        return {term(column): float(value) for (column, value) in zip(columns, values)}
+
+    def __query(self, scorer, columns, counts):
+        """ Scores of every course for a query given as its terms and their counts. """
+        if scorer not in self.SCORERS:
+            raise ValueError('Unknown scorer', scorer)
+        self.__apply_edits()
+        if self.bm25 is None:
+            self.build_bm25()
+        return self.bm25.scores(columns, counts)
+
+    def search_text(self, query, k=10, scorer='cosine'):
+        """ Return the `k` courses closest to an arbitrary text, best first.
+
+            With the cosine scorer, postings are accumulated term at a time, most important terms
+            first. Once the k-th best accumulated score is above what the remaining terms could
+            bring at most, no other course can enter the results: the remaining postings only
+            update known candidates. """
+        self.__apply_edits()
+        counts = Counter(word for word in self.hasher.terms(self.parser.tokenize(query))
+                         if self.__column(word) is not None)
+        if scorer != 'cosine':
+            columns = [self.__column(word) for word in counts]
+            scores = self.__query(scorer, columns, list(counts.values()))
+            rows = np.flatnonzero(scores)
+            return self.__rank(rows, scores[rows], k=k)
+        return self.search_weights({word: count * self.idf[self.__column(word)]
+                                    for (word, count) in counts.items()}, k)
+
+    def search_weights(self, weights, k=10, norm=None, exclude=None):
+        """ Return the `k` courses closest to a query given as {term: weight}, best first, see
+            `search_text`. Terms unknown to the engine are ignored, but count in the norm of the
+            query unless `norm` is given. The course `exclude` is left out of the results. """
+        self.__apply_edits()
+        norm = np.sqrt(sum(weight ** 2 for weight in weights.values())) if norm is None else norm
+        columns = {word: self.__column(word) for word in weights}
+        weights = {columns[word]: weight for (word, weight) in weights.items()
+                   if columns[word] is not None}
+        if not weights or k <= 0:
+            return []
+        terms = sorted(((weight / norm * self.max_weights[column], weight / norm, column)
+                        for (column, weight) in weights.items()), reverse=True)
+        remaining = sum(bound for (bound, _, _) in terms)
+        # sorted rows of the candidates and their scores, sized to the candidates only. The last
+        # one stands after every row so that every posting has a position, and the excluded
+        # course is known from the start. Both get an infinitely low score to never be ranked.
+        candidates = np.array([len(self.acronyms)], dtype=np.int64)
+        scores = np.array([-np.inf])
+        if exclude in self.rows:
+            candidates = np.insert(candidates, 0, self.rows[exclude])
+            scores = np.insert(scores, 0, -np.inf)
+        pruning = False
+        for bound, weight, column in terms:
+            rows, values = self.term_postings.row(column)
+            positions = np.searchsorted(candidates, rows)
+            known = candidates[positions] == rows
+            # weights and values are positive: scores only grow and the bound only shrinks, once
+            # the k-th best score is above the bound no other course can ever enter the results
+            if not pruning and len(candidates) > k:
+                pruning = np.partition(scores, -k)[-k] >= remaining
+            if pruning:
+                positions, values = positions[known], values[known]
+            else:
+                candidates = np.insert(candidates, positions[~known], rows[~known])
+                scores = np.insert(scores, positions[~known], 0.)
+                positions = np.searchsorted(candidates, rows)
+            scores[positions] += weight * values
+            remaining -= bound
+        ranked = np.isfinite(scores)
+        return self.__rank(candidates[ranked], scores[ranked], k=k)
+
+
+# ---------------------------------------------------------------------------- sharded search engine
+def _serve_shard(connection, options):
+    """ Loop of a shard process: run the SearchEngine methods asked by a ShardedSearchEngine on
+        the engine of its courses and send back their result, or the exception they raised. The
+        'build' message (re)builds the engine and answers its document frequencies. """
+    engine = None
+    for method, args in iter(connection.recv, None):
+        try:
+            if method == 'build':
+                courses, = args
+                # a catalog is sent as its path and the offsets of the courses of the shard
+                engine = SearchEngine(Catalog(*courses) if isinstance(courses, tuple) else courses,
+                                      **options)
+                rv = engine.document_frequencies()
+            else:
+                rv = getattr(engine, method)(*args)
+        except Exception as error:
+            connection.send((False, error))
+        else:
+            connection.send((True, rv))
+    connection.close()
+
+
+class ShardedSearchEngine:
+    """ Courses partitioned across worker processes, each one holding the SearchEngine of its
+        shard. A query is sent to every shard (scatter) and their top-k results are merged
+        (gather). Terms are weighted with the idf of the whole catalog: shards send their document
+        frequencies, which are summed and sent back to every shard, so that scores are the ones
+        of a single engine indexing every course. Only the cosine scorer is supported. """
+
+    SCORERS = ('cosine',)
+
+    def __init__(self, files, shards=None, language='french', dtype='float64', hash_size=None,
+                 bigrams=False, context=None):
+        """ Start `shards` processes (one per core by default) from the multiprocessing `context`
+            (the default one when not given) and index `files`, a list of course files or a
+            Catalog. Other arguments are those of SearchEngine. """
+        # imported here, like ProcessPoolExecutor, a module not using shards does not pay for it
+        from multiprocessing import get_context
+        context = get_context() if context is None else context
+        self.catalog = files if isinstance(files, Catalog) else None
+        self.hasher = FeatureHasher(hash_size, bigrams)
         self.parser = Parser(language=language, default_remove_stopwords=True, default_stem=True)
-        # retrieve file contents and tokenize it
-        ParsedFile = namedtuple('ParsedFile', 'title content original_content uniq_words')
-        for file in files:
-            title, original_content = parse_course(file)
-            content = self.parser.tokenize(original_content) + self.parser.tokenize(title)
-            self.files[basename(file)[:-4]] = ParsedFile(title, content, original_content,
-                                                         set(content))
-        # list of all uniq words, eventually optimised with stemming and stopwords sorting.
-        word_list = set(word for file in self.files.values() for word in file.uniq_words)
-        number_of_documents = len(files)
-        # this next operation process idf for each word in the document, it can take a while.
-        self.words_index = {word: (index, number_of_documents / self.__count_docs(word))
-                            for (index, word) in enumerate(word_list)}
-        for acronym, file in self.files.items():
-            vector = [0] * len(self.words_index)
-            for word in file.content:
-                # we add idf each time we see a word, this ends up having tf*idf
-                vector[self.words_index[word][0]] += self.words_index[word][0]
-            self.vectors[acronym] = vector
-        self.norms = Keydefaultdict(lambda acronym: norm(self.vectors[acronym]))
-        self.cosines = Keydefaultdict(lambda acr_a: Keydefaultdict(lambda acr_b: self.__cosine(
-            self.vectors[acr_a],
-            self.vectors[acr_b],
-            self.norms[acr_a],
-            self.norms[acr_b]
-        )))
+        self.connections, self.processes = [], []
+        for _ in range(cpu_count() if shards is None else shards):
+            connection, remote = context.Pipe()
+            process = context.Process(target=_serve_shard, daemon=True, args=(
+                remote, dict(language=language, dtype=dtype, hash_size=hash_size,
+                             bigrams=bigrams)))
+            process.start()
+            remote.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        # course files, or acronyms of the catalog, of each shard
+        self.partitions = [[] for _ in self.connections]
+        for course in (files if self.catalog is None else self.catalog.offsets):
+            self.partitions[self.shard(self.__acronym(course))].append(course)
+        # number of courses and document frequencies of each shard
+        self.frequencies = [(0, {})] * len(self.connections)
+        self.rebuild()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """ Stop the shard processes. """
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(None)
+            process.join()
+            connection.close()
+        self.connections, self.processes = [], []
+
+    def __acronym(self, course):
+        return basename(course)[:-4] if self.catalog is None else course
+
+    def shard(self, acronym):
+        """ Shard of a course, from a stable hash of its acronym. """
+        return crc32(acronym.encode()) % len(self.connections)
+
+    def __courses(self, shard):
+        if self.catalog is None:
+            return self.partitions[shard]
+        return self.catalog.path, OrderedDict((acronym, self.catalog.offsets[acronym])
+                                              for acronym in self.partitions[shard])
+
+    def __scatter(self, messages):
+        """ Send {shard: (method, args)} messages, run in parallel by the shards, and return
+            {shard: result} once every shard answered. """
+        for shard, message in messages.items():
+            self.connections[shard].send(message)
+        results = {shard: self.connections[shard].recv() for shard in messages}
+        for succeeded, rv in results.values():
+            if not succeeded:
+                raise rv
+        return {shard: rv for (shard, (_, rv)) in results.items()}
+
+    def __broadcast(self, method, *args):
+        return list(self.__scatter({shard: (method, args)
+                                    for shard in range(len(self.connections))}).values())
+
+    def __ask(self, acronym, method, *args):
+        """ Run a method of the engine of the shard of `acronym`. """
+        shard = self.shard(acronym)
+        return self.__scatter({shard: (method, args)})[shard]
+
+    def rebuild(self, shards=None):
+        """ Index again the courses of some shards (all of them by default), for instance after
+            their files changed, then send the new catalog statistics to every shard. """
+        shards = range(len(self.connections)) if shards is None else shards
+        for shard, frequencies in self.__scatter({shard: ('build', (self.__courses(shard),))
+                                                  for shard in shards}).items():
+            self.frequencies[shard] = frequencies
+        documents, frequencies = 0, Counter()
+        for shard_documents, shard_frequencies in self.frequencies:
+            documents += shard_documents
+            frequencies.update(shard_frequencies)
+        self.statistics = documents, frequencies
+        self.__broadcast('set_statistics', documents, frequencies)
+        self.acronyms = sorted(map(self.__acronym, chain.from_iterable(self.partitions)))
+
+    def add_course(self, course):
+        """ Index a new course file (or a course of the catalog, by its acronym), its shard is
+            rebuilt. A course appended to the catalog file since it was opened is found by
+            scanning it again. """
+        acronym = self.__acronym(course)
+        if acronym in self.acronyms:
+            raise ValueError('Course already indexed', acronym)
+        if self.catalog is not None and acronym not in self.catalog:
+            catalog = Catalog(self.catalog.path)
+            if acronym not in catalog:
+                raise KeyError(acronym)
+            self.catalog = catalog
+        shard = self.shard(acronym)
+        self.__edit(shard, self.partitions[shard] + [course])
+
+    def remove_course(self, acronym):
+        if acronym not in self.acronyms:
+            raise KeyError(acronym)
+        shard = self.shard(acronym)
+        self.__edit(shard, [course for course in self.partitions[shard]
+                            if self.__acronym(course) != acronym])
+
+    def __edit(self, shard, partition):
+        """ Rebuild a shard with new courses, its previous ones are restored if that fails (the
+            engine of a shard is only replaced by a successful build). """
+        previous, self.partitions[shard] = self.partitions[shard], partition
+        try:
+            self.rebuild([shard])
+        except Exception:
+            self.partitions[shard] = previous
+            raise
+
+    def course(self, acronym):
+        return self.__ask(acronym, 'course', acronym)
+
+    def description(self, acronym):
+        return self.__ask(acronym, 'description', acronym)
 
     @staticmethod
-    def __cosine(a, b, norm_a, norm_b):
-        return float(dot(a, b) / (norm_a * norm_b))
+    def __gather(results, k):
+        # shards sort their results as SearchEngine does, by decreasing score then by acronym
+        return sorted(chain.from_iterable(results), key=lambda result: (-result[1], result[0]))[:k]
+
+    def search(self, acronym, k=10, scorer='cosine'):
+        """ The `k` courses most similar to `acronym`, with their score, best first. Unlike
+            SearchEngine.search, courses sharing no term with it are left out. """
+        if scorer not in self.SCORERS:
+            raise ValueError('Unknown scorer', scorer)
+        weights = self.__ask(acronym, 'term_weights', acronym)
+        norm = np.sqrt(sum(weight ** 2 for weight in weights.values()))
+        return self.__gather(self.__broadcast('search_weights', weights, k, norm, acronym), k)
 
-    def search(self, acronym, sort=True, reverse_sort=True):
-        rv = [(acr, self.cosines[min(acr, acronym)][max(acr, acronym)])
-              for (acr, other_vec) in self.vectors.items() if acronym != acr]
-        return sorted(rv, key=itemgetter(1), reverse=reverse_sort) if sort else rv
+    def search_many(self, acronyms, k=10, scorer='cosine'):
+        """ `search` for several courses, yield (acronym, results) pairs in the same order. """
+        return ((acronym, self.search(acronym, k, scorer)) for acronym in acronyms)
 
-    def __count_docs(self, word):
-        """ Count in how many documents a word is present, used for the TF-IDF. """
-        # todo: move this to init loop
-        return reduce(lambda count, file: count + 1 if word in file.uniq_words else count,
-                      self.files.values(), 0)
+    def search_text(self, query, k=10, scorer='cosine'):
+        """ The `k` courses closest to an arbitrary text, best first. """
+        if scorer not in self.SCORERS:
+            raise ValueError('Unknown scorer', scorer)
+        documents, frequencies = self.statistics
+        counts = Counter(word for word in self.hasher.terms(self.parser.tokenize(query))
+                         if word in frequencies)
+        weights = {word: count * documents / frequencies[word] for (word, count) in counts.items()}
+        return self.__gather(self.__broadcast('search_weights', weights, k), k)
+
+    def stats(self):
+        """ Stages of every shard (see SearchEngine.stats), their calls and times summed. """
+        rv = OrderedDict()
+        for stats in self.__broadcast('stats'):
+            for stage, (calls, time) in stats.items():
+                total = rv.get(stage, StageStats(0, 0.))
+                rv[stage] = StageStats(total.calls + calls, total.time + time)
+        return rv
 
 
 # --------------------------------------------------------------------------------- main application
-def main(path, acronym, n=10, be_verbose=True):
-    title, description = parse_course(join(path, acronym + '.txt'))
-    if be_verbose:
-        print("Recherche des cours similaires au cours {0} ({1}):".format(acronym, title))
-    files = [join(path, f) for f in listdir(path) if isfile(join(path, f))]
-    search_result = SearchEngine(files).search(acronym, sort=True)
-    for acr, score in search_result[:n]:
+def read_acronyms(path):
+    """ Course acronyms of a file, one per line, read as they are needed. """
+    with (stdin if path == '-' else open(path)) as stream:
+        yield from filter(None, map(str.strip, stream))
+
+
+def main(path, acronym, n=10, be_verbose=True, snapshot=None, workers=1, lsh=None, lsa=None,
+         dtype='float64', profile=False, scorer='cosine', hash_size=None, bigrams=False,
+         shards=None):
+    """ Print the courses similar to `acronym`, or to each of the acronyms of an iterable. """
+    if shards:
+        engine = ShardedSearchEngine(list_courses(path), shards, dtype=dtype,
+                                     hash_size=hash_size, bigrams=bigrams)
+    else:
+        engine = open_engine(list_courses(path), snapshot, workers, dtype, hash_size, bigrams)
+    acronyms = [acronym] if isinstance(acronym, str) else acronym
+    # results of several courses are prefixed by the course they are similar to
+    prefixed = not isinstance(acronyms, list) or len(acronyms) > 1
+    if lsh:
+        engine.build_lsh(*lsh)
+        results = ((acr, engine.search_lsh(acr, k=n)) for acr in acronyms)
+    elif lsa:
+        engine.build_lsa(lsa)
+        results = ((acr, engine.search_lsa(acr, k=n)) for acr in acronyms)
+    else:
+        # several courses are scored together, results are printed as each batch is done
+        results = engine.search_many(acronyms, k=n, scorer=scorer)
+    for query, search_result in results:
         if be_verbose:
-            title, description = parse_course(join(path, acr + '.txt'))
-            print(" - {acronym}: {title} (score={score})".format(acronym=acr, title=title,
-                                                                 score=score))
-            print(description + "\n")
-        else:
-            print('{}: {}'.format(acr, score))
+            print("Recherche des cours similaires au cours {0} ({1}):".format(
+                query, engine.course(query)[0]))
+            if lsh:
+                print("Rappel par rapport à la recherche exacte: {:.2f}".format(
+                    engine.recall(engine.search_lsh, [query], k=n)))
+        for acr, score in search_result:
+            if be_verbose:
+                title, description = engine.course(acr)
+                print(" - {acronym}: {title} (score={score})".format(acronym=acr, title=title,
+                                                                     score=score))
+                print(description + "\n")
+            elif prefixed:
+                print('{} {}: {}'.format(query, acr, score))
+            else:
+                print('{}: {}'.format(acr, score))
+    if profile:
+        print('{:<36} {:>10} {:>10}'.format('étape', 'appels', 'temps (s)'))
+        for stage, (calls, time) in engine.stats().items():
+            print('{:<36} {:>10} {:>10.4f}'.format(stage, calls, time))
+    if shards:
+        engine.close()
 
 
 if __name__ == '__main__':
     args = parse_arguments()
-    main(path=args.path, acronym=args.acronym, n=args.length, be_verbose=args.verbose)
+    if args.convert:
+        convert_catalog(args.path, args.convert)
+    elif args.all_pairs:
+        engine = SearchEngine(list_courses(args.path), workers=args.workers, dtype=args.dtype,
+                              hash_size=args.hash and 2 ** args.hash, bigrams=args.bigrams)
+        if args.lsa:
+            engine.build_lsa(args.lsa)
+        engine.all_pairs(args.all_pairs, args.memory * 2 ** 20, lsa=bool(args.lsa))
+    else:
+        acronyms = args.acronym if args.acronyms_file is None else \
+            read_acronyms(args.acronyms_file)
+        options = dict(path=args.path, acronym=acronyms, n=args.length,
+                       be_verbose=args.verbose, snapshot=args.snapshot, workers=args.workers,
+                       lsh=args.lsh, lsa=args.lsa, dtype=args.dtype,
+                       profile=args.profile is not None, scorer=args.scorer,
+                       hash_size=args.hash and 2 ** args.hash, bigrams=args.bigrams,
+                       shards=args.shards)
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(main, **options)
+            profiler.dump_stats(args.profile)
+        else:
+            main(**options)
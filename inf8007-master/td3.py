@@ -1,30 +1,66 @@
 #!/usr/bin/env python3.5
-from os import listdir
-from os.path import join, isfile
+from os import environ
+from os.path import join
 
-from td2 import SearchEngine
+from td2 import list_courses, open_engine
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse
-from collections import defaultdict
+from urllib.parse import urlparse, unquote_plus
+from collections import defaultdict, OrderedDict
+import argparse
 import json
 
 
 # this is used as json generator, see https://gist.github.com/hrldcpr/2012250
 def _tree(): return defaultdict(_tree)
 
-print('Mise en place du serveur...')
 
-COURSE_PATH = '02/sample'
-FILES = [join(COURSE_PATH, f) for f in listdir(COURSE_PATH) if isfile(join(COURSE_PATH, f))]
+# catalogs served, as `name=path` separated by commas, the first one is the default one. Paths
+# are course directories or single-file catalogs (see td2.Catalog)
+CATALOGS = OrderedDict(catalog.split('=', 1) for catalog in
+                       environ.get('TD3_CATALOGS', 'sample=02/sample').split(','))
+# index snapshots (one directory per catalog), rebuilt when the course files change
+SNAPSHOT_PATH = '03/index'
+# number of processes reading the courses when the index is built
+WORKERS = int(environ.get('TD3_WORKERS', 1))
+
+
+def parse_arguments(args_=None):
+    def catalog(v):
+        if '=' not in v:
+            raise argparse.ArgumentTypeError('"{}" n’est pas de la forme NOM=CHEMIN'.format(v))
+        return tuple(v.split('=', 1))
+
+    parser = argparse.ArgumentParser(description='Serveur de recherche du TD3')
+    parser.add_argument('-c', '--catalog', type=catalog, action='append', dest='catalogs',
+                        metavar='NOM=CHEMIN',
+                        help='Catalogue servi, répétable, le premier est celui par défaut '
+                             '(TD3_CATALOGS par défaut)')
+    parser.add_argument('-i', '--index', type=str, dest='snapshot', metavar='DOSSIER',
+                        help='Dossier des instantanés des index, un par catalogue')
+    parser.add_argument('-j', '--workers', type=int, dest='workers',
+                        help='Nombre de processus utilisés pour lire les cours')
+    parser.add_argument('-p', '--port', type=int, dest='port', help='Port du serveur')
+    parser.set_defaults(catalogs=None, snapshot=SNAPSHOT_PATH, workers=WORKERS, port=8765)
+    return parser.parse_args(args_)
+
+
+def open_engines(catalogs=CATALOGS, snapshot=SNAPSHOT_PATH, workers=WORKERS):
+    """ Search engines of the catalogs, a {name: path} mapping, in the same order. """
+    return OrderedDict((name, open_engine(list_courses(path), join(snapshot, name), workers))
+                       for (name, path) in catalogs.items())
 
 
 class AppHandler(BaseHTTPRequestHandler):
-    search_engine = SearchEngine(FILES)
+    # set by `run`, importing this module does not index anything
+    search_engines = OrderedDict()
 
     def do_GET(self):
         """
         L’accession aux données se fait avec les paramètres suivant :
-         - acronym (REQUIS) — le sigle du cours
+         - acronym (REQUIS sauf si q est donné) — le sigle du cours
+         - catalog — nom du catalogue de cours, le premier servi par défaut
+         - scorer — calcul des scores, cosine (par défaut) ou bm25
+         - q — texte libre à rechercher à la place d’un sigle
          - sort — tri dans l’ordre décroissant des valeurs obtenues
          - length — nombre d’elements
         :return:
@@ -33,23 +69,41 @@ class AppHandler(BaseHTTPRequestHandler):
         args = dict(i.split('=') for i in query.split('&'))
         args['sort'] = bool(args['sort']) if 'sort' in args else True
         args['length'] = int(args['length']) if 'length' in args else 10
+        args.setdefault('scorer', 'cosine')
         print(args)
+        search_engine = self.search_engines.get(args.get('catalog',
+                                                         next(iter(self.search_engines))))
+        if search_engine is None:
+            self.send_error(404, 'Catalogue inconnu: {}'.format(args['catalog']))
+            return
+        if args['scorer'] not in search_engine.SCORERS:
+            self.send_error(400, 'Score inconnu: {}'.format(args['scorer']))
+            return
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
         body = _tree()
-        search_result = self.search_engine.search(args['acronym'], args['sort'])[:args['length']]
-        body['data'] = [{'acr': acr, 'val': value, 'desc': self.search_engine.files[acr].original_content}
+        if 'q' in args:
+            search_result = search_engine.search_text(unquote_plus(args['q']), args['length'],
+                                                      args['scorer'])
+        else:
+            search_result = search_engine.search(args['acronym'], args['sort'], k=args['length'],
+                                                 scorer=args['scorer'])
+        body['data'] = [{'acr': acr, 'val': value, 'desc': search_engine.description(acr)}
                         for acr, value in search_result]
         self.wfile.write(bytes(json.dumps(body), encoding="utf-8"))
 
 
-def run():
-    httpd = HTTPServer(('localhost', 8765), AppHandler)
-    print('Serveur accessible à l’adresse http://localhost:8765. '
-          'Appuyez sur ctrl-c pour interrompre.')
+def run(catalogs=CATALOGS, snapshot=SNAPSHOT_PATH, workers=WORKERS, port=8765):
+    print('Mise en place du serveur...')
+    AppHandler.search_engines = open_engines(catalogs, snapshot, workers)
+    httpd = HTTPServer(('localhost', port), AppHandler)
+    print('Serveur accessible à l’adresse http://localhost:{}. '
+          'Appuyez sur ctrl-c pour interrompre.'.format(port))
     httpd.serve_forever()
 
 if __name__ == '__main__':
-    run()
+    args = parse_arguments()
+    run(CATALOGS if args.catalogs is None else OrderedDict(args.catalogs), args.snapshot,
+        args.workers, args.port)
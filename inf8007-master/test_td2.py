@@ -1,8 +1,14 @@
 from os import listdir
-from os.path import isfile, join
+from os.path import isfile, join, basename
 from unittest import TestCase, main
 from IPython.utils.capture import capture_output
 from difflib import SequenceMatcher
+from tempfile import TemporaryDirectory
+from io import StringIO
+from collections import Counter
+import json
+import subprocess
+import sys
 import td2
 
 COURSE_PATH = '02/sample'
@@ -12,16 +18,25 @@ FILES = [join(COURSE_PATH, f) for f in listdir(COURSE_PATH) if isfile(join(COURS
 class TestMisc(TestCase):
     def test_parse_arguments(self):
         defaults = td2.parse_arguments()
-        self.assertEqual('INF8007', defaults.acronym)
+        self.assertEqual(['INF8007'], defaults.acronym)
         self.assertEqual('02/PolyHEC', defaults.path)
         self.assertEqual(10, defaults.length)
         self.assertTrue(defaults.verbose)
 
         parsed = td2.parse_arguments(str.split('-d a/path -n 42 --quiet LOG3430'))
-        self.assertEqual('LOG3430', parsed.acronym)
+        self.assertEqual(['LOG3430'], parsed.acronym)
         self.assertEqual('a/path', parsed.path)
         self.assertEqual(42, parsed.length)
         self.assertFalse(parsed.verbose)
+        self.assertIsNone(parsed.profile)
+        self.assertEqual('', td2.parse_arguments(['--profile']).profile)
+        self.assertEqual(['LOG3430', 'INF8007'],
+                         td2.parse_arguments(str.split('LOG3430 INF8007')).acronym)
+        self.assertEqual(4, td2.parse_arguments(str.split('--shards 4')).shards)
+        for options in ('--lsa 8', '--lsh 4 8', '--scorer bm25', '-i index', '-j 2'):
+            with capture_output():
+                self.assertRaises(SystemExit, td2.parse_arguments,
+                                  str.split('--shards 4 ' + options))
 
     def test_main(self):
         for i in ('verbose', 'quiet'):
@@ -31,6 +46,13 @@ class TestMisc(TestCase):
                     d = SequenceMatcher(None, f.read(), c.stdout).quick_ratio()
                     assert d > 0.9
 
+    def test_lazy_imports(self):
+        # nltk is only imported by a parser, and td3 does not index anything when imported
+        code = 'import sys, td3; print("nltk" in sys.modules, len(td3.AppHandler.search_engines))'
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                                universal_newlines=True, check=True).stdout
+        self.assertEqual('False 0', output.strip())
+
     def test_parse_course(self):
         self.assertTupleEqual(('Langages de script',
                                "Caracteristiques des langages de script. Principaux langages et dom"
@@ -67,6 +89,62 @@ class TestParser(TestCase):
                          self.parser.tokenize('Jean va à la fontaine', True, True),
                          msg='removing stopwords and stemming')
 
+    def test_iter_tokens(self):
+        text = 'Jean va à la fontaine,&nbsp; puis (sifflement) au moulin.&nbsp;\n' * 3
+        for chunk_size in (1, 3, 7, 64):
+            self.assertEqual(self.parser.tokenize(text, True, True),
+                             list(self.parser.iter_tokens(StringIO(text), True, True,
+                                                          chunk_size=chunk_size)))
+        self.assertEqual([], list(self.parser.iter_tokens(StringIO(''))))
+
+    def test_stem_cache(self):
+        parser = td2.Parser('french', stem_cache_size=2)
+        self.assertEqual(['siffl', 'siffl', 'fontain'],
+                         parser.tokenize('sifflement sifflement fontaine', False, True))
+        self.assertEqual((1, 2, 2, 2), parser.stem_cache_info())
+        parser.stem('jean')
+        self.assertNotIn('sifflement', parser.stems, msg='least recently used word is evicted')
+        with TemporaryDirectory() as directory:
+            parser.save_stems(join(directory, 'stems.tsv'))
+            preloaded = td2.Parser('french', stem_table=join(directory, 'stems.tsv'))
+        self.assertEqual('fontain', preloaded.stem('fontaine'))
+        self.assertEqual((1, 0, 2 ** 16, 2), preloaded.stem_cache_info())
+
+
+class TestSparseMatrix(TestCase):
+    matrix = td2.SparseMatrix.from_coordinates([2, 0, 0], [1, 2, 0], [3., 2., 1.], (3, 3))
+
+    def test_dot(self):
+        self.assertEqual([7., 0., 6.], list(self.matrix.dot(td2.np.array([1., 2., 3.]))))
+        self.assertEqual([[7., 1.], [0., 0.], [6., 0.]],
+                         self.matrix.dot(td2.np.array([[1., 1.], [2., 0.], [3., 0.]])).tolist())
+        self.assertEqual([[0., 3., 0.], [1., 0., 2.]],
+                         self.matrix.take_rows([2, 0]).dense_rows(0, 2).tolist())
+        self.assertEqual([1., 0., 2.], list(self.matrix.dense_row(0)))
+        self.assertAlmostEqual(5 ** .5, self.matrix.row_norms()[0])
+
+    def test_astype(self):
+        quantized = self.matrix.astype('int8')
+        self.assertEqual([64, 127, 127], quantized.data.tolist())
+        self.assertTrue(td2.np.allclose([2 / 127, 0., 3 / 127], quantized.scales))
+        self.assertTrue(td2.np.allclose([7., 0., 6.], quantized.dot(td2.np.array([1., 2., 3.])),
+                                        atol=.05))
+        self.assertEqual([[0., 3., 0.]], quantized.take_rows([2]).dense_rows(0, 1).tolist())
+        self.assertEqual('float16', self.matrix.astype('float16').dtype)
+        self.assertLess(quantized.nbytes, self.matrix.nbytes)
+
+
+class TestInvertedIndex(TestCase):
+    def test_add(self):
+        index = td2.InvertedIndex()
+        index.add(0, 'a b a'.split())
+        index.add(1, 'b c'.split())
+        self.assertEqual({0: 2}, index.postings['a'])
+        self.assertEqual({0: 1, 1: 1}, index.postings['b'])
+        self.assertEqual(2, index.df('b'))
+        self.assertEqual(2., index.idf('c'))
+        self.assertEqual(['a', 'b', 'c'], index.vocabulary())
+
 
 class TestSearchEngine(TestCase):
     engine = td2.SearchEngine(language='french', files=FILES)
@@ -76,6 +154,390 @@ class TestSearchEngine(TestCase):
         self.assertEqual(list, type(search_value))
         self.assertEqual('INF1025', search_value[0][0])
         self.assertEqual(len(FILES) - 1, len(search_value))
+        for acr, score in search_value:
+            pair = sorted((acr, 'INF0330'))
+            self.assertAlmostEqual(score, self.engine.cosine(*pair))
+
+    def test_cosine_cache(self):
+        engine = td2.SearchEngine(FILES)
+        engine.cosines = td2.CosineCache(maxsize=2 * td2.CosineCache.PAIR_BYTES)
+        for acronym in ('INF1025', 'INF8007', 'INF1025', 'INF1010'):
+            engine.cosine('INF0330', acronym)
+        self.assertEqual((1, 3, 1, 2, 2 * td2.CosineCache.PAIR_BYTES),
+                         engine.cosine_cache_info()[:5])
+        self.assertNotIn(('INF0330', 'INF8007'), engine.cosines)
+        engine.cosines = td2.CosineCache()
+        scores = engine.scores('INF0330')
+        self.assertIs(scores, engine.scores('INF0330'))
+        self.assertEqual(scores[engine.rows['INF8007']], engine.cosine('INF8007', 'INF0330'))
+        self.assertEqual((2, 1), engine.cosine_cache_info()[:2])
+        self.assertFalse(scores.flags.writeable)
+
+    def test_search_k(self):
+        search_value = self.engine.search('INF0330')
+        self.assertEqual(search_value[:3], self.engine.search('INF0330', k=3))
+        self.assertEqual(search_value[::-1][:2],
+                         self.engine.search('INF0330', reverse_sort=False, k=2))
+        self.assertEqual(search_value, self.engine.search('INF0330', k=len(FILES)))
+        self.assertEqual([], self.engine.search('INF0330', k=0))
+
+    def test_all_pairs(self):
+        engine = td2.SearchEngine(language='french', files=FILES)
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'pairs.npy')
+            # a tiny budget forces the matrix to be computed block by block
+            pairs = engine.all_pairs(path, memory_budget=2 ** 16)
+            self.assertEqual((len(FILES), len(FILES)), pairs.shape)
+            search_value = engine.search('INF0330')
+            engine.open_pairs(path)
+            self.assertFalse(engine.pairs.flags.writeable)
+            for (acr, score), expected in zip(engine.search('INF0330'), search_value):
+                self.assertEqual(expected[0], acr)
+                self.assertAlmostEqual(expected[1], score, places=6)
+            self.assertAlmostEqual(search_value[0][1], engine.cosine('INF0330', 'INF1025'),
+                                   places=6)
+            del engine.pairs, pairs
+
+    def test_snapshot(self):
+        with TemporaryDirectory() as directory:
+            self.engine.save(directory)
+            engine = td2.SearchEngine.load(directory, FILES)
+            self.assertEqual(self.engine.search('INF0330'), engine.search('INF0330'))
+            self.assertEqual(self.engine.search_text('script', k=3),
+                             engine.search_text('script', k=3))
+            self.assertEqual(td2.parse_course(join(COURSE_PATH, 'INF8007.txt'))[1],
+                             engine.description('INF8007'))
+            self.assertRaises(td2.StaleSnapshotError, td2.SearchEngine.load, directory, FILES[1:])
+            del engine
+            # pretend a course file was modified after the snapshot was saved
+            with open(join(directory, 'manifest.json')) as stream:
+                manifest = json.load(stream)
+            manifest['sources'][0][2] -= 1
+            with open(join(directory, 'manifest.json'), 'w') as stream:
+                json.dump(manifest, stream)
+            self.assertRaises(td2.StaleSnapshotError, td2.SearchEngine.load, directory)
+
+    def test_snapshot_overwrite(self):
+        # parts of a previous snapshot saved in the same directory must not be read
+        with TemporaryDirectory() as directory:
+            previous = td2.SearchEngine(FILES, dtype='int8')
+            previous.build_ivf()
+            previous.save(directory)
+            self.engine.save(directory)
+            engine = td2.SearchEngine.load(directory, FILES)
+            self.assertEqual(self.engine.search('INF0330'), engine.search('INF0330'))
+            self.assertIsNone(engine.ivf)
+            del engine
+
+    def test_edits(self):
+        path = join(COURSE_PATH, 'INF8007.txt')
+        engine = td2.SearchEngine([file for file in FILES if file != path])
+        # the index is only rebuilt, from the term counts, to be edited
+        self.assertIsNone(engine.index)
+        # keep the idf weights, edited vectors are spliced into the matrix
+        engine.IDF_REFRESH_RATIO = 1
+        self.assertGreater(engine.cosine('INF0330', 'INF1025'), 0)
+        engine.add_course(path)
+        engine.remove_course('INF1025')
+        self.assertNotIn(('INF0330', 'INF1025'), engine.cosines)
+        self.assertRaises(ValueError, engine.add_course, path)
+        self.assertRaises(KeyError, engine.remove_course, 'INF1025')
+        search_value = engine.search('INF8007')
+        self.assertEqual(len(FILES) - 2, len(search_value))
+        for acr, score in search_value:
+            pair = sorted((acr, 'INF8007'))
+            self.assertAlmostEqual(score, engine.cosine(*pair))
+        with TemporaryDirectory() as directory:
+            engine.save(directory)
+            engine = td2.SearchEngine.load(directory)
+            # every weight is computed again on the next query
+            engine.IDF_REFRESH_RATIO = 0
+            engine.add_course(join(COURSE_PATH, 'INF1025.txt'))
+            engine.update_course(path)
+            for (acr, score), expected in zip(engine.search('INF0330'),
+                                              self.engine.search('INF0330')):
+                self.assertEqual(expected[0], acr)
+                self.assertAlmostEqual(expected[1], score)
+            del engine
+
+    def test_failed_update(self):
+        # a course file that cannot be read leaves the course indexed as it was
+        engine = td2.SearchEngine(FILES)
+        with TemporaryDirectory() as directory:
+            self.assertRaises(FileNotFoundError, engine.update_course,
+                              join(directory, 'INF0330.txt'))
+        self.assertEqual(self.engine.search('INF0330'), engine.search('INF0330'))
+        self.assertEqual(self.engine.search_text('programmation'),
+                         engine.search_text('programmation'))
+
+    def test_quantized_edits(self):
+        # the index of a loaded int8 snapshot is rebuilt from exact term counts, not from the
+        # quantized weights where a frequent word leaves the others at zero
+        path = join(COURSE_PATH, 'INF1025.txt')
+        text = 'programmation ' * 3000 + 'objets et classes'
+        engine = td2.SearchEngine([file for file in FILES if file != path], dtype='int8')
+        engine.add_document('XYZ1000', StringIO(text))
+        with TemporaryDirectory() as directory:
+            engine.save(directory)
+            engine = td2.SearchEngine.load(directory)
+            engine.IDF_REFRESH_RATIO = 0
+            engine.add_course(path)
+            self.assertEqual(Counter(engine.parser.tokenize(text)),
+                             engine.index.documents['XYZ1000'])
+            reference = td2.SearchEngine(FILES, dtype='int8')
+            reference.add_document('XYZ1000', StringIO(text))
+            reference.IDF_REFRESH_RATIO = 0
+            for (acr, score), expected in zip(engine.search('INF0330'),
+                                              reference.search('INF0330')):
+                self.assertEqual(expected[0], acr)
+                self.assertAlmostEqual(expected[1], score)
+            del engine
+
+    def test_float16_range(self):
+        # tf*idf weights above 65504, the biggest float16, are stored scaled
+        text = 'programmation ' * 70000
+        engine = td2.SearchEngine(FILES, dtype='float16')
+        engine.add_document('XYZ1000', StringIO(text))
+        reference = td2.SearchEngine(FILES)
+        reference.add_document('XYZ1000', StringIO(text))
+        for (acr, score), expected in zip(engine.search('XYZ1000'), reference.search('XYZ1000')):
+            self.assertEqual(expected[0], acr)
+            self.assertAlmostEqual(expected[1], score, places=3)
+
+    def test_add_document(self):
+        engine = td2.SearchEngine(FILES)
+        title, description = td2.parse_course(join(COURSE_PATH, 'INF8007.txt'))
+        engine.add_document('SYL8007', StringIO(description), title=title)
+        self.assertEqual('SYL8007', engine.search('INF8007')[0][0])
+        self.assertAlmostEqual(1., engine.search('INF8007')[0][1])
+        self.assertIsNone(engine.description('SYL8007'))
+
+    def test_catalog(self):
+        with TemporaryDirectory() as directory:
+            for name in ('catalog.jsonl', 'catalog.tsv'):
+                path = join(directory, name)
+                td2.convert_catalog(COURSE_PATH, path)
+                catalog = td2.list_courses(path)
+                self.assertEqual(len(FILES), len(catalog))
+                engine = td2.SearchEngine(catalog)
+                self.assertEqual(self.engine.search('INF0330'), engine.search('INF0330'))
+                engine.save(join(directory, 'index'))
+                engine = td2.SearchEngine.load(join(directory, 'index'), td2.Catalog(path))
+                self.assertEqual(td2.parse_course(join(COURSE_PATH, 'INF0330.txt')),
+                                 engine.course('INF0330'))
+                engine.description('INF0330')
+                self.assertEqual((1, 1, 256, 1), engine.documents.cache_info())
+                del engine, catalog
+            # acronyms are read without decoding the records, whatever the order of their keys
+            path = join(directory, 'records.jsonl')
+            with open(path, 'w') as stream:
+                stream.write('{"acronym": "A\\"1\\u00e9", "title": "t", "description": "d"}\n')
+                stream.write('{"title": "t", "acronym": "B2", "description": "d"}\n')
+            self.assertEqual(['A"1é', 'B2'], list(td2.Catalog(path).offsets))
+
+    def test_search_many(self):
+        results = list(self.engine.search_many(reversed(self.engine.acronyms), k=3,
+                                               memory_budget=2 ** 12))
+        self.assertEqual(self.engine.acronyms[::-1], [acronym for (acronym, _) in results])
+        for acronym, search_value in results:
+            expected = self.engine.search(acronym, k=3)
+            self.assertEqual([acr for (acr, _) in expected], [acr for (acr, _) in search_value])
+            for (_, score), (_, expected_score) in zip(search_value, expected):
+                self.assertAlmostEqual(expected_score, score)
+
+    def test_bm25(self):
+        engine = td2.SearchEngine(FILES)
+        search_value = engine.search('INF0330', k=3, scorer='bm25')
+        self.assertEqual('INF1025', search_value[0][0])
+        self.assertGreater(search_value[0][1], search_value[1][1])
+        self.assertEqual(search_value, dict(engine.search_many(['INF0330'], k=3,
+                                                               scorer='bm25'))['INF0330'])
+        self.assertEqual('INF1010', engine.search_text('classes et objets', k=1,
+                                                       scorer='bm25')[0][0])
+        self.assertRaises(ValueError, engine.search, 'INF0330', scorer='foo')
+        # counts are exact whatever the storage of the vectors, even for the rare words of a
+        # course whose int8 weights are rounded to zero
+        results = []
+        for dtype in ('float64', 'int8'):
+            edited = td2.SearchEngine(FILES, dtype=dtype)
+            edited.add_document('XYZ1000', StringIO('programmation ' * 3000 + 'objets classes'))
+            results.append(edited.search('XYZ1000', k=3, scorer='bm25'))
+        self.assertEqual(*results)
+        with TemporaryDirectory() as directory:
+            engine.save(directory)
+            loaded = td2.SearchEngine.load(directory)
+            self.assertIsNotNone(loaded.bm25)
+            self.assertEqual(search_value, loaded.search('INF0330', k=3, scorer='bm25'))
+            del loaded
+
+    def test_hashing(self):
+        hasher = td2.FeatureHasher(2 ** 16, bigrams=True)
+        terms = list(hasher.terms(['class', 'objet', 'java']))
+        self.assertEqual(5, len(terms))
+        self.assertEqual(hasher.column('class objet'), terms[2])
+        self.assertEqual(0., hasher.collision_rate(['class', 'objet']))
+        self.assertEqual(1., td2.FeatureHasher(1).collision_rate(['class', 'objet']))
+        engine = td2.SearchEngine(FILES, hash_size=2 ** 16)
+        self.assertEqual((len(FILES), 2 ** 16), engine.vectors.shape)
+        search_value = engine.search('INF0330', k=3)
+        self.assertEqual([acr for (acr, _) in self.engine.search('INF0330', k=3)],
+                         [acr for (acr, _) in search_value])
+        with TemporaryDirectory() as directory:
+            engine.save(directory)
+            self.assertRaises(td2.StaleSnapshotError, td2.SearchEngine.load, directory,
+                              hasher=td2.FeatureHasher())
+            loaded = td2.SearchEngine.load(directory, hasher=td2.FeatureHasher(2 ** 16))
+            self.assertEqual(search_value, loaded.search('INF0330', k=3))
+            # hashed terms are their own column, there is no vocabulary to keep
+            self.assertIsNone(loaded.words_index)
+            self.assertFalse(isfile(join(directory, 'vocabulary.txt')))
+            loaded.add_document('XYZ1000', StringIO('Compilateurs et analyse lexicale'))
+            self.assertEqual('XYZ1000', loaded.search_text('analyse lexicale', k=1)[0][0])
+            del loaded
+
+    def test_shards(self):
+        with td2.ShardedSearchEngine(FILES, shards=3) as engine:
+            self.assertEqual(sorted(FILES), sorted(sum(engine.partitions, [])))
+            self.assertEqual(self.engine.acronyms, engine.acronyms)
+            for acronym in ('INF0330', 'INF8007'):
+                expected = self.engine.search(acronym, k=3)
+                search_value = engine.search(acronym, k=3)
+                self.assertEqual([acr for (acr, _) in expected], [acr for (acr, _) in search_value])
+                for (_, score), (_, expected_score) in zip(search_value, expected):
+                    self.assertAlmostEqual(expected_score, score)
+            self.assertEqual(self.engine.search_text('classes et objets', k=2),
+                             engine.search_text('classes et objets', k=2))
+            self.assertEqual(self.engine.course('INF0330'), engine.course('INF0330'))
+            self.assertRaises(KeyError, engine.search, 'INF0000')
+            # idf weights follow the removal of a course from one of the shards
+            engine.remove_course('INF1010')
+            reference = td2.SearchEngine([file for file in FILES if 'INF1010' not in file])
+            self.assertEqual([acr for (acr, _) in reference.search('INF0330', k=3)],
+                             [acr for (acr, _) in engine.search('INF0330', k=3)])
+            self.assertAlmostEqual(reference.search('INF0330', k=1)[0][1],
+                                   engine.search('INF0330', k=1)[0][1])
+            # a failed rebuild leaves the shards as they were
+            self.assertRaises(FileNotFoundError, engine.add_course,
+                              join(COURSE_PATH, 'INF0000.txt'))
+            engine.rebuild()
+            self.assertEqual(len(FILES) - 1, len(engine.acronyms))
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'catalog.jsonl')
+            td2.Catalog.write(path, [(basename(file)[:-4],) + tuple(td2.parse_course(file))
+                                     for file in FILES if 'INF1010' not in file])
+            with td2.ShardedSearchEngine(td2.Catalog(path), shards=2) as engine:
+                self.assertRaises(KeyError, engine.add_course, 'INF1010')
+                # a record appended to the catalog is found by scanning it again
+                with open(path, 'a') as stream:
+                    stream.write(json.dumps(dict(acronym='INF1010', title='Programmation',
+                                                 description='Classes et objets.')) + '\n')
+                engine.add_course('INF1010')
+                self.assertEqual('Programmation', engine.course('INF1010')[0])
+
+    def test_stats(self):
+        engine = td2.SearchEngine(FILES)
+        engine.search('INF0330')
+        engine.search('INF0330')
+        stats = engine.stats()
+        for stage in ('parsing', 'tokenizing', 'document frequency'):
+            self.assertEqual(len(FILES), stats[stage].calls)
+        self.assertEqual((1, 2, 1), (stats['vectorization'].calls, stats['search'].calls,
+                                     stats['cosine'].calls))
+        self.assertLessEqual(stats['stemming'].time, stats['tokenizing'].time)
+
+    def test_isolation(self):
+        engine = td2.SearchEngine(FILES[:3])
+        self.assertEqual(len(FILES), len(self.engine.documents))
+        self.assertEqual(3, len(engine.documents))
+        shared = set(engine.words_index).intersection(self.engine.words_index)
+        self.assertTrue(shared)
+        words = {word: word for word in self.engine.words_index}
+        for word in engine.words_index:
+            if word in shared:
+                self.assertIs(words[word], word, msg='terms are interned')
+
+    def test_parallel_build(self):
+        engine = td2.SearchEngine(FILES, workers=3)
+        self.assertEqual(self.engine.words_index, engine.words_index)
+        self.assertEqual(self.engine.acronyms, engine.acronyms)
+        for name in td2.SparseMatrix.ARRAYS:
+            self.assertEqual(getattr(self.engine.vectors, name).tolist(),
+                             getattr(engine.vectors, name).tolist())
+
+    def test_dtype(self):
+        for dtype in ('float32', 'float16', 'int8'):
+            engine = td2.SearchEngine(FILES, dtype=dtype)
+            self.assertEqual(dtype, engine.vectors.dtype)
+            self.assertEqual(dtype, engine.term_postings.dtype)
+            self.assertEqual(td2.np.float32, engine.norms.dtype)
+            self.assertEqual([acr for (acr, _) in self.engine.search('INF0330', k=3)],
+                             [acr for (acr, _) in engine.search('INF0330', k=3)])
+            self.assertTrue(td2.np.allclose(self.engine.scores('INF0330'),
+                                            engine.scores('INF0330'), atol=.01))
+        with TemporaryDirectory() as directory:
+            engine.save(directory)
+            self.assertEqual('int8', td2.SearchEngine.load(directory).vectors.dtype)
+            with self.assertRaises(td2.StaleSnapshotError):
+                td2.SearchEngine.load(directory, dtype='float64')
+
+    def test_search_lsh(self):
+        engine = td2.SearchEngine(FILES)
+        self.assertEqual(1., engine.recall(engine.search, k=3))
+        # many tables of few bits: nearly every course is a candidate
+        engine.build_lsh(tables=16, bits=2)
+        self.assertEqual(engine.search('INF0330', k=3), engine.search_lsh('INF0330', k=3))
+        self.assertGreater(engine.recall(engine.search_lsh, k=3), .9)
+        engine.build_lsh(tables=1, bits=32)
+        self.assertLessEqual(len(engine.search_lsh('INF0330')), len(FILES) - 1)
+        self.assertLess(engine.recall(engine.search_lsh, k=3), .9)
+
+    def test_search_ivf(self):
+        engine = td2.SearchEngine(FILES)
+        engine.build_ivf(clusters=3, batch_size=4, iterations=10)
+        self.assertEqual(len(FILES), len(engine.ivf.assignments))
+        # probing every cluster is an exhaustive search
+        self.assertEqual(engine.search('INF0330', k=5),
+                         engine.search_ivf('INF0330', k=5, nprobe=3))
+        self.assertLessEqual(len(engine.search_ivf('INF0330', nprobe=1)), len(FILES) - 1)
+        with TemporaryDirectory() as directory:
+            engine.save(directory)
+            loaded = td2.SearchEngine.load(directory)
+            self.assertEqual(engine.ivf.assignments.tolist(), loaded.ivf.assignments.tolist())
+            self.assertEqual(engine.search_ivf('INF0330', nprobe=2),
+                             loaded.search_ivf('INF0330', nprobe=2))
+            del loaded
+
+    def test_search_lsa(self):
+        engine = td2.SearchEngine(FILES)
+        # as many dimensions as courses: the decomposition is exact
+        engine.build_lsa(dimensions=len(FILES))
+        self.assertEqual(td2.np.float32, engine.lsa.embeddings.dtype)
+        self.assertTrue(engine.lsa.embeddings.flags.c_contiguous)
+        for (acr, score), expected in zip(engine.search_lsa('INF0330', k=5),
+                                          engine.search('INF0330', k=5)):
+            self.assertEqual(expected[0], acr)
+            self.assertAlmostEqual(expected[1], score, places=5)
+        engine.build_lsa(dimensions=4)
+        self.assertEqual((len(FILES), 4), engine.lsa.embeddings.shape)
+        self.assertGreater(engine.recall(engine.search_lsa, k=3), .5)
+        with TemporaryDirectory() as directory:
+            pairs = engine.all_pairs(join(directory, 'pairs.npy'), lsa=True)
+            acr, score = engine.search_lsa('INF0330', k=1)[0]
+            self.assertAlmostEqual(score, pairs[engine.rows['INF0330'], engine.rows[acr]],
+                                   places=5)
+            del pairs
+
+    def test_search_text(self):
+        title, description = td2.parse_course(join(COURSE_PATH, 'INF0330.txt'))
+        search_value = self.engine.search_text(description + ' ' + title, k=3)
+        self.assertEqual(3, len(search_value))
+        self.assertEqual('INF0330', search_value[0][0])
+        self.assertAlmostEqual(1., search_value[0][1])
+        for (acr, score), expected in zip(search_value[1:], self.engine.search('INF0330')):
+            self.assertEqual(expected[0], acr)
+            self.assertAlmostEqual(expected[1], score)
+        self.assertEqual('INF8007', self.engine.search_text('Langages de script', k=1)[0][0])
+        self.assertEqual([], self.engine.search_text('le la les'))
 
 
 if __name__ == '__main__':